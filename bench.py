@@ -0,0 +1,232 @@
+#!/usr/bin/python3
+
+# Loopback benchmark: starts peers on localhost in a temporary folder, drives a Client against them and
+# reports latency and throughput of each command as JSON, e.g.
+#   bench.py sizes 1K,1M,100M peers 1,3 clients 1,4 repeat 5 output bench.json
+# Server options (engine, backlog, idle, iothreads, workers, cache) are passed on to the peers, and client options
+# (window, compress, keepalive) are picked up by the Client from the command line as usual.
+
+from pathlib import Path
+from threading import Thread, Barrier
+from time import perf_counter, sleep
+from math import ceil
+from hashlib import sha256
+import subprocess
+import tempfile
+import platform
+import shutil
+import socket
+import json
+import sys
+import os
+
+SERVER_OPTIONS = ("engine", "backlog", "idle", "iothreads", "workers", "cache")
+UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+STARTUP_TIMEOUT = 10 # s for a peer to start listening
+
+def path(path: str) -> Path:
+    return Path(__file__).parent / path
+
+def argument(name: str) -> str | None:
+    args = sys.argv[1:]
+    if name in args and args.index(name) + 1 < len(args):
+        return args[args.index(name) + 1]
+    return None
+
+# "1K" -> 1024
+def parseSize(size: str) -> int:
+    if size[-1].upper() in UNITS:
+        return int(float(size[:-1]) * UNITS[size[-1].upper()])
+    return int(size)
+
+# Nearest-rank percentile
+def percentile(values: list[float], p: float) -> float:
+    ordered = sorted(values)
+    return ordered[max(ceil(p / 100 * len(ordered)) - 1, 0)]
+
+def freePort() -> int:
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+def waitForPort(port: int) -> bool:
+    deadline = perf_counter() + STARTUP_TIMEOUT
+    while perf_counter() < deadline:
+        try:
+            socket.create_connection(("localhost", port), timeout=1).close()
+            return True
+        except OSError:
+            sleep(0.05)
+    return False
+
+# Write size bytes to filepath, returning their sha256. Text content compresses, random content does not
+def writeFile(filepath: Path, size: int, text: bool) -> str:
+    digest = sha256()
+    block = path("src/server.py").read_bytes() if text else None
+    with open(filepath, "wb") as f:
+        written = 0
+        while written < size:
+            data = (block if text else os.urandom(1024 * 1024))[:size - written]
+            f.write(data)
+            digest.update(data)
+            written += len(data)
+    return digest.hexdigest()
+
+def fileHash(filepath: Path) -> str | None:
+    digest = sha256()
+    try:
+        with open(filepath, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+    except OSError:
+        return None
+    return digest.hexdigest()
+
+
+class Bench:
+    root: Path # Temporary folder holding peer_settings.txt and one folder per peer
+    servers: list[str]
+    processes: list[subprocess.Popen]
+    client: "object" # The client module, loaded from the client peer's folder
+    text: bool
+    repeat: int
+    results: list[dict]
+
+    def __init__(self, noOfServers: int):
+        self.root = Path(tempfile.mkdtemp(prefix="bench"))
+        self.servers = [f"s{i}" for i in range(noOfServers)]
+        self.processes = []
+        self.text = argument("content") == "text"
+        self.repeat = int(argument("repeat") or 3)
+        self.results = []
+        ports = {id: freePort() for id in self.servers}
+        with open(self.root / "peer_settings.txt", "w") as settings:
+            for id, port in ports.items():
+                settings.write(f"{id} localhost {port}\n")
+        for id in self.servers + ["c0"]:
+            os.makedirs(self.root / id / "served_files")
+            shutil.copy2(path("src/client.py"), self.root / id / "client.py")
+            shutil.copy2(path("src/server.py"), self.root / id / "server.py")
+        serverArgs = [arg for option in SERVER_OPTIONS if argument(option) is not None for arg in (option, argument(option))]
+        for id in self.servers:
+            self.processes.append(subprocess.Popen([sys.executable, "server.py", id, *serverArgs], cwd=self.root / id, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+        for id, port in ports.items():
+            if not waitForPort(port):
+                self.close()
+                raise RuntimeError(f"Peer {id} did not start")
+        # Served files resolve relative to the module, so the client must be loaded from its own peer folder
+        sys.path.insert(0, str(self.root / "c0"))
+        import client
+        self.client = client
+
+    def served(self, id: str, filename: str) -> Path:
+        return self.root / id / "served_files" / filename
+
+    # Run command(clientNo) on every client at once and check(clientNo) its outcome, returning (latencies, failures, wall time)
+    def phase(self, clients: list, command, check) -> tuple[list[float], int, float]:
+        latencies: list[float] = []
+        failures = [0]
+        barrier = Barrier(len(clients))
+
+        def run(clientNo: int):
+            barrier.wait()
+            start = perf_counter()
+            clients[clientNo].execute(command(clientNo))
+            latencies.append(perf_counter() - start)
+            if not check(clientNo):
+                failures[0] += 1
+
+        start = perf_counter()
+        threads = [Thread(target=run, args=(clientNo,)) for clientNo in range(len(clients))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return latencies, failures[0], perf_counter() - start
+
+    def scenario(self, size: int, noOfPeers: int, noOfClients: int):
+        peers = self.servers[:noOfPeers]
+        clients = [self.client.Client() for _ in range(noOfClients)]
+        stats: dict[str, tuple[list[float], int, float, int]] = {op: ([], 0, 0.0, 0) for op in ("UPLOAD", "FILELIST", "DOWNLOAD", "DELETE")}
+
+        def record(op: str, result: tuple[list[float], int, float], noOfBytes: int):
+            latencies, failures, wall, total = stats[op]
+            stats[op] = (latencies + result[0], failures + result[1], wall + result[2], total + noOfBytes)
+
+        for repetition in range(self.repeat):
+            names = [f"b{size}-{clientNo}-{repetition}.bin" for clientNo in range(noOfClients)]
+            hashes = [writeFile(self.served("c0", name), size, self.text) for name in names]
+
+            record("UPLOAD", self.phase(clients,
+                lambda clientNo: f"#UPLOAD {names[clientNo]} {" ".join(peers)}",
+                lambda clientNo: all(fileHash(self.served(id, names[clientNo])) == hashes[clientNo] for id in peers)), size * noOfPeers * noOfClients)
+            for name in names: # So that the download actually transfers
+                self.served("c0", name).unlink(missing_ok=True)
+            record("FILELIST", self.phase(clients,
+                lambda clientNo: f"#FILELIST {peers[0]}",
+                lambda clientNo: True), 0)
+            record("DOWNLOAD", self.phase(clients,
+                lambda clientNo: f"#DOWNLOAD {names[clientNo]} {" ".join(peers)}",
+                lambda clientNo: fileHash(self.served("c0", names[clientNo])) == hashes[clientNo]), size * noOfClients)
+            record("DELETE", self.phase(clients,
+                lambda clientNo: f"#DELETE {names[clientNo]} {" ".join(peers)}",
+                lambda clientNo: not any(self.served(id, names[clientNo]).exists() for id in peers)), 0)
+            for name in names:
+                self.served("c0", name).unlink(missing_ok=True)
+
+        for client in clients:
+            client.pool.close()
+        for op, (latencies, failures, wall, total) in stats.items():
+            self.results.append({
+                "op": op,
+                "size": size,
+                "peers": noOfPeers,
+                "clients": noOfClients,
+                "count": len(latencies),
+                "failures": failures,
+                "p50Ms": round(percentile(latencies, 50) * 1000, 3),
+                "p99Ms": round(percentile(latencies, 99) * 1000, 3),
+                "throughputMBps": round(total / wall / 1e6, 3) if total > 0 else None
+            })
+            print(f"{op} {size}B peers {noOfPeers} clients {noOfClients}: p50 {self.results[-1]["p50Ms"]}ms p99 {self.results[-1]["p99Ms"]}ms{f", {self.results[-1]["throughputMBps"]}MB/s" if total > 0 else ""}{f", {failures} failed" if failures > 0 else ""}", file=sys.stderr)
+
+    def close(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.wait()
+        if "keep" not in sys.argv[1:]:
+            shutil.rmtree(self.root, ignore_errors=True)
+
+
+def bench():
+    sizes = [parseSize(size) for size in (argument("sizes") or "1K,1M").split(",")]
+    peerCounts = [int(peers) for peers in (argument("peers") or "1").split(",")]
+    clientCounts = [int(clients) for clients in (argument("clients") or "1").split(",")]
+    bench = Bench(max(peerCounts))
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w") # The client reports every command and chunk on stdout
+    try:
+        for size in sizes:
+            for noOfPeers in peerCounts:
+                for noOfClients in clientCounts:
+                    bench.scenario(size, noOfPeers, noOfClients)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        bench.close()
+    report = json.dumps({
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "arguments": sys.argv[1:],
+        "repeat": bench.repeat,
+        "results": bench.results
+    }, indent=2)
+    if argument("output") is not None:
+        with open(argument("output"), "w") as output:
+            output.write(report + "\n")
+    else:
+        print(report)
+
+if __name__ == "__main__":
+    bench()
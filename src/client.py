@@ -1,15 +1,43 @@
-from server import served, readSettings, CommandType, UserCommand, Command, Response, ResponseCode, sever, reintegrate, getsize, parentFolderName
-from socket import socket, AF_INET, SOCK_STREAM, error as SocketError
+from server import served, partial, fileDigest, textChunks, readSettings, CommandType, UserCommand, Command, Response, ResponseCode, getsize, parentFolderName, argument, PartialFile, REPLICA_TIMEOUT, CHUNK_SIZE, MAX_CHUNK_SIZE, MAX_RANGE_SIZE, chooseChunkSize, noOfChunks, splitRanges, chunkReader, fileIndex, toBytes, Connection, Codec, PROTOCOL_VERSION
+from socket import socket, AF_INET, SOCK_STREAM, IPPROTO_TCP, TCP_NODELAY, error as SocketError
 from os.path import exists
-from threading import Thread, RLock
+from threading import Thread, Condition, RLock, BoundedSemaphore, Event
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from queue import SimpleQueue, Empty
 import sys
-from math import ceil
 import os
-from time import sleep, time_ns
+from time import perf_counter, sleep, monotonic
+from math import ceil
+from random import shuffle, choice
+from hashlib import sha256
+from typing import Callable, Iterable
+import json
+import tempfile
+import shutil
 
 debug = False
 
-downloadLock = RLock()
+
+MAX_IN_FLIGHT_BYTES = 64 * 1024 * 1024 # Caps the window so that large chunks do not pile up in socket buffers
+RANGES_PER_PEER = 16 # Byte ranges per peer when downloading, enough for the queue to shift work from slow to fast peers
+MAX_HOLDERS = 2 # Peers a download task may be in flight on at once, i.e. at most one re-issue per straggler
+KEEPALIVE_INTERVAL = 0.3 # s a pooled connection may sit idle before it is pinged, leaving a round trip before the servers' default idle timeout
+KEEPALIVE_PERIOD = 5 # s an unused pooled connection is kept alive, after which it is closed instead of pinged
+MAX_IDLE_CONNECTIONS = 4 # Per peer, kept in the pool
+PROBE_TIMEOUT = 1 # s all peers get to answer a download intent
+MAX_ATTEMPTS = 3 # Times an upload is sent before giving up on chunks the server keeps finding corrupt
+BATCH_CONCURRENCY = 4 # Commands a batch runs at once unless told otherwise
+MAX_FANOUT_BYTES = 64 * 1024 * 1024 # Chunks read for one upload peer and kept for the others
+AVAILABILITY_INTERVAL = 0.25 # s between asking a peer that is still downloading a file which chunks it holds, below the servers' default idle timeout
+REPROBE_INTERVAL = 1 # s before the peers that declined a download are asked again, doubling each time up to MAX_REPROBE_INTERVAL
+MAX_REPROBE_INTERVAL = 8 # s
+SWARM_PATIENCE = 10 # s a peer that is still downloading a file may go without holding anything this download needs
+STRIPE_BLOCK_SIZE = 1024 * 1024 # bytes, striping unit: shard i holds blocks i, i + k, i + 2k, ... of the file
+STRIPE_RANGE_SIZE = 8 * 1024 * 1024 # bytes requested at once when fetching a shard
+STRIPE_SUFFIX = ".stripe" # Manifest of a striped file, stored on every peer holding one of its shards
+SHARD_SUFFIX = ".shard" # Followed by the shard no.
+GF_POLYNOMIAL = 0x11d # Reduces products in GF(2^8), the field the parity shards are computed in
 
 def error(message: str) -> None:
     global debug
@@ -22,156 +50,735 @@ def log(message: str):
     if debug:
         print(message, end="" if message.endswith("\n") else "\n")
 
-class PartialDownload:
-    filename: str
-    size: int # bytes
-    chunks: dict[int, str] # Map chunk no. to bytes
-
-    def __init__(self, filename: str, size: int):
-        self.filename = filename
-        self.size = size
-        self.chunks = dict()
-    
-    def noOfChunks(self) -> int:
-        return ceil(float(self.size) / 100.0)
-
-    def isComplete(self) -> bool:
-        return all([chunk in self.chunks for chunk in range(self.noOfChunks())])
-    
-    def save(self, chunk: int, content: str):
-        self.chunks[chunk] = content
-    
-    def writeToDisk(self):
-        log("In PartialDownload.writeToDisk() point 0")
-        if not self.isComplete():
-            return error(f"Upload for {self.filename} is not complete")
-        log("In PartialDownload.writeToDisk() point 1")
-        if exists(served(self.filename)):
-            return error(f"{served(self.filename)} already exists")
-        log("In PartialDownload.writeToDisk() point 2")
-        log(f"{self.chunks}")
+class PartialDownload(PartialFile):
+    succeeded: bool = False # Moved into place
+
+    # Move the file into place once complete, for exactly one of the workers
+    def complete(self):
+        if not self.finish():
+            return
+        if not self.verify():
+            self.discard()
+            print(f"File {self.filename} download failed, content does not match its digest")
+            return
+        self.writeToDisk()
+        self.succeeded = True
+        print(f"File {self.filename} download success")
+
+class Window:
+    size: int # Max no. of chunk requests in flight
+    limit: int # Upper bound for the adaptive window
+    adaptive: bool
+    minRtt: float | None # s
+
+    def __init__(self, size: int = 8, adaptive: bool = False, limit: int = 64):
+        self.size = size if not adaptive else 1
+        self.limit = limit
+        self.adaptive = adaptive
+        self.minRtt = None
+
+    def update(self, rtt: float):
+        if not self.adaptive:
+            return
+        if self.minRtt is None or rtt < self.minRtt:
+            self.minRtt = rtt
+        if rtt <= self.minRtt * 1.5: # RTT is flat, the link can take more
+            self.size = min(self.size + 1, self.limit)
+        else: # Requests are queueing up, back off
+            self.size = max(self.size // 2, 1)
+
+    def toString(self) -> str:
+        return "auto" if self.adaptive else str(self.size)
+
+
+# Chunks or byte ranges of a download, handed out to whichever ClientWorker asks next.
+# Once nothing is left to hand out, tasks that a slow peer is sitting on are re-issued to peers that would have finished them by now (endgame).
+class DownloadQueue:
+    lengths: dict[int, int] # Map task (chunk no. or range offset) to its length in bytes
+    ranges: bool # Tasks are byte ranges rather than chunks
+    chunkSize: int # Of the download, the unit partial holders fetch byte ranges in
+    noOfPeers: int
+    pending: deque[int] # Tasks no peer is working on
+    holders: dict[int, dict[str, float]] # Map task in flight to the peers working on it and when they were sent it
+    done: set[int]
+    throughput: dict[str, float] # Map peer to bytes/s, moving average
+    lastDone: dict[str, float] # Map peer to when it last finished a task
+    available: dict[str, tuple[bytes, int]] # Map peer still downloading the file itself to (bitmap of chunks it holds, chunk size)
+    condition: Condition # Guards all of the above, notified when tasks finish or come back
+
+    def __init__(self, tasks: list[tuple[int, int]], ranges: bool, chunkSize: int, noOfPeers: int):
+        self.lengths = dict(tasks)
+        self.ranges = ranges
+        self.chunkSize = chunkSize
+        self.noOfPeers = noOfPeers
+        self.pending = deque(task for task, _ in tasks)
+        self.holders = dict()
+        self.done = set()
+        self.throughput = dict()
+        self.lastDone = dict()
+        self.available = dict()
+        self.condition = Condition()
+
+    def requestSize(self) -> int:
+        return max(self.lengths.values(), default=1)
+
+    def addPeer(self):
+        with self.condition:
+            self.noOfPeers += 1
+
+    def isFinished(self) -> bool:
+        with self.condition:
+            return len(self.done) == len(self.lengths)
+
+    def holds(self, serverId: str) -> int:
+        with self.condition:
+            return sum(1 for holders in self.holders.values() if serverId in holders)
+
+    # Record which chunks serverId holds, None once it holds the whole file. Only for byte range tasks
+    def setAvailable(self, serverId: str, have: bytes | None, chunkSize: int | None = None):
+        with self.condition:
+            if have is None:
+                self.available.pop(serverId, None)
+            else:
+                self.available[serverId] = (have, chunkSize)
+            self.condition.notify_all()
+
+    def isPartial(self, serverId: str) -> bool:
+        with self.condition:
+            return serverId in self.available
+
+    # Whether serverId holds every chunk the task spans
+    def has(self, serverId: str, task: int) -> bool:
+        return self.covers(serverId, task, self.lengths[task])
+
+    # Whether serverId holds every chunk of the byte range
+    def covers(self, serverId: str, offset: int, length: int) -> bool:
+        if serverId not in self.available:
+            return True
+        have, chunkSize = self.available[serverId]
+        if length == 0:
+            return True
+        chunks = range(offset // chunkSize, (offset + length - 1) // chunkSize + 1)
+        return all(chunk // 8 < len(have) and have[chunk // 8] >> (chunk % 8) & 1 for chunk in chunks)
+
+    # Split a random chunk that serverId holds off a pending range, as a task of its own. Peers still downloading the
+    # file fetch single chunks in random order, so that downloaders that started together come to hold different
+    # chunks and can fetch them from each other, while peers holding the whole file keep fetching whole ranges
+    def carve(self, serverId: str) -> int | None:
+        held = [(index, offset) for index, task in enumerate(self.pending) for offset in range(task, task + max(self.lengths[task], 1), self.chunkSize) if self.covers(serverId, offset, min(self.chunkSize, task + self.lengths[task] - offset))]
+        if len(held) == 0:
+            return None
+        index, offset = choice(held)
+        task = self.pending[index]
+        end = task + self.lengths.pop(task)
+        length = min(self.chunkSize, end - offset)
+        del self.pending[index]
+        for piece, pieceLength in reversed([(task, offset - task), (offset + length, end - offset - length)]):
+            if pieceLength > 0: # The rest of the range stays where it was in the queue
+                self.pending.insert(index, piece)
+                self.lengths[piece] = pieceLength
+        self.lengths[offset] = length
+        return offset
+
+    # Next (task, length) for serverId, or None if there is nothing it should do right now
+    def take(self, serverId: str) -> tuple[int, int] | None:
+        with self.condition:
+            if len(self.pending) > 0:
+                # No more than a fair share of the remaining tasks at once, so that one peer's window does not swallow the whole queue
+                remaining = len(self.pending) + sum(1 for task in self.holders if task not in self.done)
+                if self.holds(serverId) >= ceil(remaining / self.noOfPeers):
+                    return None
+                if serverId not in self.available:
+                    task = self.pending.popleft()
+                elif self.ranges:
+                    task = self.carve(serverId)
+                else:
+                    task = next((task for task in self.pending if self.has(serverId, task)), None)
+                    if task is not None:
+                        self.pending.remove(task)
+                if task is None: # Holds none of what is left yet
+                    return None
+            else:
+                task = self.straggler(serverId)
+                if task is None:
+                    return None
+            self.holders.setdefault(task, dict())[serverId] = perf_counter()
+            return task, self.lengths[task]
+
+    def straggler(self, serverId: str) -> int | None:
+        now = perf_counter()
+        rate = self.throughput.get(serverId)
+        candidates = sorted((min(holders.values()), task) for task, holders in self.holders.items() if task in self.lengths and task not in self.done and serverId not in holders and len(holders) < MAX_HOLDERS and self.has(serverId, task))
+        for sent, task in candidates:
+            if rate is not None and now - sent > self.lengths[task] / rate: # serverId would have been done by now
+                return task
+        return None
+
+    # Record that serverId fetched task. True for the first peer to do so, who must then save it
+    def claim(self, task: int, serverId: str) -> bool:
+        with self.condition:
+            now = perf_counter()
+            holders = self.holders.get(task, dict())
+            sent = holders.pop(serverId, None)
+            if len(holders) == 0:
+                self.holders.pop(task, None)
+            if task not in self.lengths: # Replaced by refetch() meanwhile
+                return False
+            if sent is not None:
+                # Time since the previous response rather than since sending, so that pipelined requests are not counted twice
+                rate = self.lengths[task] / max(now - max(sent, self.lastDone.get(serverId, sent)), 1e-6)
+                self.throughput[serverId] = rate if serverId not in self.throughput else (self.throughput[serverId] + rate) / 2
+                self.lastDone[serverId] = now
+            if task in self.done:
+                return False
+            self.done.add(task)
+            self.condition.notify_all()
+            return True
+
+    # The claimed task could not be saved, let another peer fetch it
+    def retry(self, task: int):
+        with self.condition:
+            self.done.discard(task)
+            self.pending.appendleft(task)
+            self.condition.notify_all()
+
+    # Parts of the claimed task arrived corrupt, fetch just those parts (chunk no. or offset, length) again
+    def refetch(self, task: int, parts: list[tuple[int, int]]):
+        with self.condition:
+            self.done.discard(task)
+            self.lengths.pop(task)
+            for part, length in parts:
+                self.lengths[part] = length
+                self.pending.appendleft(part)
+            self.condition.notify_all()
+
+    # serverId failed, hand the tasks only it was working on to the other peers
+    def abandon(self, serverId: str):
+        with self.condition:
+            for task, holders in list(self.holders.items()):
+                if holders.pop(serverId, None) is not None and len(holders) == 0:
+                    self.holders.pop(task)
+                    if task not in self.done:
+                        self.pending.appendleft(task)
+            self.condition.notify_all()
+
+    # Until there may be something for serverId to take
+    def wait(self, serverId: str, timeout: float = 0.05):
+        with self.condition:
+            if (len(self.pending) == 0 or serverId in self.available) and not self.isFinished():
+                self.condition.wait(timeout)
+
+
+# Exponentials and logarithms of the generator 2 of GF(2^8), exponentials repeated so that log sums need no reduction
+def gfTables() -> tuple[list[int], list[int]]:
+    exp, log = [0] * 510, [0] * 256
+    x = 1
+    for i in range(255):
+        exp[i] = exp[i + 255] = x
+        log[x] = i
+        x <<= 1
+        if x & 0x100:
+            x ^= GF_POLYNOMIAL
+    return exp, log
+
+GF_EXP, GF_LOG = gfTables()
+
+def gfMultiply(a: int, b: int) -> int:
+    return 0 if a == 0 or b == 0 else GF_EXP[GF_LOG[a] + GF_LOG[b]]
+
+def gfInverse(a: int) -> int:
+    return GF_EXP[255 - GF_LOG[a]]
+
+# Gauss-Jordan elimination over GF(2^8), matrix must be invertible
+def gfInvert(matrix: list[list[int]]) -> list[list[int]]:
+    n = len(matrix)
+    rows = [row + [int(i == j) for j in range(n)] for i, row in enumerate(matrix)]
+    for column in range(n):
+        pivot = next(row for row in range(column, n) if rows[row][column] != 0)
+        rows[column], rows[pivot] = rows[pivot], rows[column]
+        inverse = gfInverse(rows[column][column])
+        rows[column] = [gfMultiply(inverse, value) for value in rows[column]]
+        for row in range(n):
+            if row != column and rows[row][column] != 0:
+                factor = rows[row][column]
+                rows[row] = [value ^ gfMultiply(factor, pivotValue) for value, pivotValue in zip(rows[row], rows[column])]
+    return [row[n:] for row in rows]
+
+# Systematic Reed-Solomon code: k data shards are stored as they are, and m parity shards are sums of
+# multiples of them, with coefficients from a Cauchy matrix so that any k of the k + m shards determine the
+# data. Addition in GF(2^8) is XOR, done on whole blocks as big integers; multiplying a block by a constant
+# is a byte-for-byte table lookup, which bytes.translate() does in C.
+class ErasureCode:
+    k: int # Data shards
+    m: int # Parity shards
+    parity: list[list[int]] # Parity shard j is the sum over i of parity[j][i] times data shard i
+    tables: dict[int, bytes] # Map coefficient to its multiplication table
+
+    def __init__(self, k: int, m: int):
+        assert 0 < k and 0 <= m and k + m <= 256
+        self.k = k
+        self.m = m
+        self.parity = [[gfInverse(j ^ (m + i)) for i in range(k)] for j in range(m)]
+        self.tables = dict()
+
+    def multiply(self, coefficient: int, block: bytes) -> bytes:
+        if coefficient == 1:
+            return block
+        if coefficient not in self.tables:
+            self.tables[coefficient] = bytes(gfMultiply(coefficient, x) for x in range(256))
+        return block.translate(self.tables[coefficient])
+
+    # Sum of coefficients[i] times blocks[i], the blocks being of the same length
+    def combine(self, coefficients: list[int], blocks: list[bytes]) -> bytes:
+        total = 0
+        for coefficient, block in zip(coefficients, blocks):
+            if coefficient != 0:
+                total ^= int.from_bytes(self.multiply(coefficient, block), "little")
+        return total.to_bytes(len(blocks[0]), "little")
+
+    # Parity blocks for one block of each data shard
+    def encode(self, blocks: list[bytes]) -> list[bytes]:
+        return [self.combine(coefficients, blocks) for coefficients in self.parity]
+
+    # Coefficients that rebuild each data shard from the k shards available, given by shard no.
+    def decoder(self, available: list[int]) -> list[list[int]]:
+        return gfInvert([[int(shard == i) for i in range(self.k)] if shard < self.k else list(self.parity[shard - self.k]) for shard in available])
+
+
+# Chunks of a file uploaded to several peers at once, read from disk once by whichever worker gets to them
+# first and kept until every other worker has taken them. Memory is capped at MAX_FANOUT_BYTES; a worker
+# that falls so far behind that its chunks could not be kept reads them from disk again.
+class ChunkFeed:
+    path: str
+    size: int
+    needed: dict[tuple[int, int], int] # Map (chunk size, chunk no.) to no. of workers yet to take the chunk
+    cached: dict[tuple[int, int], bytes]
+    cachedBytes: int
+    loading: set[tuple[int, int]] # Being read by some worker, the others wait for it
+    condition: Condition
+
+    def __init__(self, path: str):
+        self.path = path
+        self.size = getsize(path)
+        self.needed = dict()
+        self.cached = dict()
+        self.cachedBytes = 0
+        self.loading = set()
+        self.condition = Condition()
+
+    # A worker will take each of chunks once
+    def register(self, chunkSize: int, chunks: Iterable[int]):
+        with self.condition:
+            for chunk in chunks:
+                self.needed[(chunkSize, chunk)] = self.needed.get((chunkSize, chunk), 0) + 1
+
+    def take(self, chunkSize: int, chunk: int) -> bytes:
+        key = (chunkSize, chunk)
+        with self.condition:
+            while key in self.loading:
+                self.condition.wait()
+            if key in self.cached:
+                content = self.cached[key]
+                self.release(chunkSize, [chunk])
+                return content
+            self.loading.add(key)
         try:
-            with open(served(self.filename), 'x') as f:
-                combined = reintegrate([self.chunks[chunk] for chunk in range(self.noOfChunks())])
-                noChars = f.write(combined)
-                assert noChars == len(combined)
-        except Exception as e:
-            error(f"{e}")
-        log("In PartialDownload.writeToDisk() point 3")
+            content = chunkReader.readChunk(self.path, chunk, chunkSize)
+        finally:
+            with self.condition:
+                self.loading.discard(key)
+                self.condition.notify_all()
+        with self.condition:
+            self.release(chunkSize, [chunk])
+            if self.needed.get(key, 0) > 0 and self.cachedBytes + len(content) <= MAX_FANOUT_BYTES:
+                self.cached[key] = content
+                self.cachedBytes += len(content)
+        return content
+
+    # A worker will not take these chunks after all, e.g. because its peer failed
+    def release(self, chunkSize: int, chunks: Iterable[int]):
+        with self.condition:
+            for chunk in chunks:
+                key = (chunkSize, chunk)
+                if key not in self.needed:
+                    continue
+                self.needed[key] -= 1
+                if self.needed[key] == 0:
+                    self.needed.pop(key)
+                    content = self.cached.pop(key, None)
+                    if content is not None:
+                        self.cachedBytes -= len(content)
+
+
+# Open connections to peers, reused across commands and workers.
+# Idle protocol v2 connections are pinged so that servers do not time them out; any that died anyway are replaced on acquire().
+class ConnectionPool:
+    servers: dict[str, tuple[str, int]] # Map server ids to (addr, port)
+    idle: dict[str, list[Connection]] # Map server ids to connections not in use
+    released: dict[Connection, tuple[float, float]] # Map idle connections to when they were released and last heard from
+    keepalive: float # s of idleness before a ping, 0 to let idle connections lapse
+    lock: RLock # Guards idle and released
+
+    def __init__(self, servers: dict[str, tuple[str, int]], keepalive: float = KEEPALIVE_INTERVAL):
+        self.servers = servers
+        self.idle = dict()
+        self.released = dict()
+        self.keepalive = keepalive
+        self.lock = RLock()
+        if keepalive > 0:
+            Thread(target=self.keepAlive, daemon=True).start()
+
+    # A healthy connection to serverId, reusing an idle one if possible
+    def acquire(self, serverId: str) -> Connection | None:
+        with self.lock:
+            idle = self.idle.get(serverId, [])
+            while len(idle) > 0:
+                connection = idle.pop()
+                self.released.pop(connection, None)
+                if connection.isAlive():
+                    return connection
+                connection.close()
+        return self.connect(serverId)
+
+    # Hand back a connection with no responses outstanding, closed connections are dropped
+    def release(self, serverId: str, connection: Connection):
+        with self.lock:
+            idle = self.idle.setdefault(serverId, [])
+            if connection.isAlive() and len(idle) < MAX_IDLE_CONNECTIONS:
+                idle.append(connection)
+                self.released[connection] = (monotonic(), monotonic())
+                return
+        connection.close()
+
+    def connect(self, serverId: str) -> Connection | None:
+        server = self.servers.get(serverId)
+        if server is None:
+            return error(f"Unknown peer {serverId}")
+        clientSocket = self.newSocket(server)
+        if clientSocket is None:
+            return None
+        connection = Connection(clientSocket)
+        if connection.negotiate():
+            return connection
+        # Old peer, reconnect and stay on the text protocol
+        log(f"Server {serverId} does not speak protocol v2, falling back to text protocol")
+        connection.close()
+        clientSocket = self.newSocket(server)
+        return Connection(clientSocket) if clientSocket is not None else None
+
+    def newSocket(self, server: tuple[str, int]) -> socket | None:
+        try:
+            ret = socket(AF_INET, SOCK_STREAM)
+            ret.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1) # Requests are small and latency bound
+            ret.settimeout(1)
+            ret.connect(server)
+            return ret
+        except (SocketError, ConnectionRefusedError, TimeoutError):
+            return error(f"Could not connect to {server} in ConnectionPool.newSocket")
+
+    # Ping each idle connection just before the server would drop it, for KEEPALIVE_PERIOD after its last use.
+    # An idle prompt thus costs the peers a few pings per connection, not a steady stream
+    def keepAlive(self):
+        while True:
+            sleep(self.keepalive / 4)
+            now = monotonic()
+            due: list[tuple[str, Connection, float]] = []
+            expired: list[Connection] = []
+            with self.lock:
+                for serverId, idle in self.idle.items():
+                    for connection in list(idle):
+                        releasedAt, heardAt = self.released[connection]
+                        if now - releasedAt > KEEPALIVE_PERIOD:
+                            expired.append(connection)
+                        elif connection.binary and now - heardAt >= self.keepalive: # Old peers drop the connection on #PROTOCOL
+                            due.append((serverId, connection, releasedAt))
+                        else:
+                            continue
+                        idle.remove(connection)
+                        self.released.pop(connection)
+            for connection in expired:
+                connection.close()
+            for serverId, connection, releasedAt in due:
+                if connection.send(Command(CommandType.PROTOCOL, content=str(PROTOCOL_VERSION))):
+                    response = connection.receiveResponse()
+                    if response is not None and response.code.ok():
+                        with self.lock:
+                            idle = self.idle.setdefault(serverId, [])
+                            if len(idle) < MAX_IDLE_CONNECTIONS:
+                                idle.append(connection)
+                                self.released[connection] = (releasedAt, monotonic())
+                                continue
+                connection.close()
+
+    def close(self):
+        with self.lock:
+            for idle in self.idle.values():
+                for connection in idle:
+                    connection.close()
+            self.idle = dict()
+            self.released = dict()
+
 
 class ClientWorker(Thread):
-    clientSocket: socket
-    serverAddr: str
-    serverPort: int
+    connection: Connection
+    pool: ConnectionPool
     userCommand: UserCommand
     serverId: str
     download: PartialDownload | None
-    downloadChunkIds: list[int] | None
+    queue: DownloadQueue | None
+    digest: tuple[str, list[str]] | None # Digest and chunk hashes of the file to upload
+    feed: ChunkFeed | None # Chunks of the file to upload, shared with the workers uploading it to other peers
     clientId: str
+    window: Window
+    codec: Codec | None # Compression to ask an upload peer for, or that a download peer agreed to
+    succeeded: bool # The command went through on this peer; downloads are judged by the PartialDownload instead
 
     def __init__(self, group=None, target=None, name=None, args=..., kwargs=None, *, daemon=None):
         super().__init__(group, target, name, args, kwargs, daemon=daemon)
-        self.clientSocket = socket(AF_INET, SOCK_STREAM)
-        self.clientSocket.settimeout(0.5)
         self.serverId = kwargs["serverId"]
         self.clientId = kwargs["clientId"]
-        self.serverAddr, self.serverPort = kwargs["server"]
+        self.pool = kwargs["pool"]
         self.download = kwargs["download"]
-        self.downloadChunkIds = kwargs["downloadChunkIds"]
-        try:
-            self.clientSocket.connect((self.serverAddr, self.serverPort))
-        except (SocketError, ConnectionRefusedError, TimeoutError):
+        self.queue = kwargs.get("queue")
+        self.digest = kwargs.get("digest")
+        self.feed = kwargs.get("feed")
+        self.window = kwargs.get("window") or Window(1)
+        self.codec = kwargs.get("codec")
+        self.succeeded = False
+        connection = self.pool.acquire(self.serverId)
+        if connection is None:
             print(f"TCP connection to server {self.serverId} failed")
-            raise
+            raise ConnectionRefusedError(f"Could not connect to server {self.serverId}")
+        self.connection = connection
         self.userCommand = kwargs["userCommand"]
         self._return = None
         log(f"New ClientWorker connected to server {self.serverId}")
 
     def getResponse(self, command: Command) -> Response | None:
-        try:
-            print(f"Client ({self.serverId}): {command.toDisplayString()}")
-            self.clientSocket.send(command.toSafeString().encode())
-        except (SocketError, TimeoutError):
-            return error(f"Could not send command to {self.servers[id]}")
-        responseStr = ""
-        start = time_ns()
-        while not responseStr.endswith("\n"):
-            now = time_ns()
-            if now - start > 1E9:
-                return error("Timeout while receiving")
-            try:
-                buffer = self.clientSocket.recv(1024)
-            except (SocketError, TimeoutError):
-                return error(f"Could not receive response from {self.servers[id]}")
-            if len(buffer) == 0:
-                return error(f"Server {self.serverId} closed connection")
-            responseStr += buffer.decode()
-        response: Response = Response.fromSafeString(responseStr)
+        print(f"Client ({self.serverId}): {command.toDisplayString()}")
+        if not self.connection.send(command):
+            self.connection.close()
+            return error(f"Could not send command to server {self.serverId}")
+        response = self.connection.receiveResponse()
+        if response is None:
+            self.connection.close() # A late response would be mistaken for the next one
+            return error(f"Could not receive response from server {self.serverId}")
         print(f"Server ({self.serverId}): {response.toDisplayString()}")
         return response
 
+    # Keep up to window.size chunk or range commands in flight, calling onResponse(chunk or offset, response) as responses arrive.
+    # Returns False as soon as sending/receiving fails or onResponse returns False.
+    # Stops waiting for outstanding responses once isDone() is True, e.g. when other peers delivered them already.
+    def pipeline(self, commands: Iterable[Command | None], requestSize: int, onResponse: Callable[[int, Response], bool], isDone: Callable[[], bool] = lambda: False) -> bool:
+        if not self.connection.binary: # Legacy servers only read one command per recv
+            self.window = Window(1)
+        inFlight: dict[int, float] = dict() # Map chunk no. or range offset to time sent
+        try:
+            for command in commands:
+                if command is None: # Nothing to send for now, wait for a response instead
+                    if len(inFlight) > 0 and not self.awaitResponse(inFlight, onResponse):
+                        return False
+                    continue
+                while len(inFlight) >= min(self.window.size, max(MAX_IN_FLIGHT_BYTES // requestSize, 1)):
+                    if not self.awaitResponse(inFlight, onResponse):
+                        return False
+                print(f"Client ({self.serverId}): {command.toDisplayString()}")
+                if not self.connection.send(command):
+                    self.connection.close()
+                    return error(f"Could not send command to server {self.serverId}")
+                inFlight[command.offset if command.offset is not None else command.chunk] = perf_counter()
+            while len(inFlight) > 0 and not isDone():
+                if not self.awaitResponse(inFlight, onResponse):
+                    return False
+            return True
+        finally:
+            if len(inFlight) > 0: # Responses still on their way, the connection cannot be reused
+                self.connection.close()
+
+    def awaitResponse(self, inFlight: dict[int, float], onResponse: Callable[[int, Response], bool]) -> bool:
+        response = self.connection.receiveResponse()
+        if response is None:
+            return error(f"Could not receive response from server {self.serverId}")
+        print(f"Server ({self.serverId}): {response.toDisplayString()}")
+        key = response.offset if response.offset is not None else response.chunk if response.chunk is not None else response.value("chunk")
+        if key not in inFlight: # Responses come back in order, e.g. the final upload response does not echo the chunk no.
+            key = next(iter(inFlight))
+        self.window.update(perf_counter() - inFlight.pop(key))
+        return onResponse(key, response)
+
     def handleFilelist(self):
         assert self.userCommand.type == CommandType.FILELIST
         response = self.getResponse(
-            Command(CommandType.FILELIST, filename=self.userCommand.filename))
+            Command(CommandType.FILELIST, pattern=self.userCommand.pattern, offset=self.userCommand.offset, limit=self.userCommand.limit))
         if response is None:
             return error("No response in ClientWorker.handleFilelist")
         if response.code.err():
             return error(response.toString())
+        self.succeeded = True
+
+    def handleStats(self):
+        assert self.userCommand.type == CommandType.STATS
+        response = self.getResponse(Command(CommandType.STATS))
+        if response is None:
+            return error("No response in ClientWorker.handleStats")
+        if response.code.err():
+            return error(response.toString())
+        self.succeeded = True
 
     def handleUpload(self):
         assert self.userCommand.type == CommandType.UPLOAD
         assert self.userCommand.filename is not None
         name = self.userCommand.filename
-        path = served(name)
+        path = self.feed.path if self.feed is not None else served(name)
         if not exists(path):
             # print(f"Peer {}") # TODO
             return error(f"File {name} does not exist")
-        size = getsize(path)
+        feed = self.feed or ChunkFeed(path)
+        text = textChunks(path) if not self.connection.binary else None
+        size = feed.size if text is None else sum(len(chunk) for chunk in text)
+        digest, hashes = self.digest if self.digest is not None and self.connection.binary else (None, None)
+        replicate = self.userCommand.replicate if self.connection.binary else None
         response = self.getResponse(
-            Command(CommandType.UPLOAD, filename=name, bytes=size))
+            Command(CommandType.UPLOAD, filename=name, bytes=size, chunkSize=chooseChunkSize(size) if self.connection.binary else None, digest=digest, hashes=hashes, codec=self.codec if self.connection.binary else None, replicate=replicate))
+        if response is not None and response.code.ok(): # Server already had the content
+            return self.uploaded(response)
         if response is None or not response.code.ready():
             return error(response.toString() if response is not None else "Response is None in ClientWorker.handleUpload()")
-        chunks = sever(path)
-        log(f"{len(chunks)} chunks\n\n{chunks}")
-        for i, chunk in enumerate(chunks):
-            log(f"Send chunk {i}\n{chunk}")
-            response = self.getResponse(
-                Command(CommandType.UPLOAD, filename=name, chunk=i, content=chunk))
-            if response is None or not response.code.ok():
-                print(f"File {name} upload failed")
+        chunkSize = response.value("chunksize") or CHUNK_SIZE
+        held = bytes.fromhex(response.option("received") or "") # Bitmap of chunks the server kept from an earlier attempt
+        chunks = [chunk for chunk in range(noOfChunks(size, chunkSize)) if chunk // 8 >= len(held) or not held[chunk // 8] & (1 << (chunk % 8))]
+        log(f"{noOfChunks(size, chunkSize)} chunks, {len(chunks)} to send")
+        codec = Codec.fromString(response.option("compress")) # Unless the server does not decompress
+        for _ in range(MAX_ATTEMPTS):
+            corrupt: list[int] = [] # Chunks the server could not match against the manifest
+
+            def onResponse(chunk: int, response: Response) -> bool:
+                if response.content == f"File {name} chunk {chunk} is corrupt":
+                    corrupt.append(chunk)
+                    return True
+                if not response.code.ok():
+                    return False
+                if response.content.startswith(f"File {name} received"):
+                    self.uploaded(response)
+                return True
+
+            # Take each chunk just before sending it so that the server does not sit idle while the whole file is read
+            if text is None:
+                feed.register(chunkSize, chunks)
+            remaining = deque(chunks)
+
+            def commands() -> Iterable[Command]:
+                while len(remaining) > 0:
+                    content = feed.take(chunkSize, remaining[0]) if text is None else text[remaining[0]]
+                    yield Command(CommandType.UPLOAD, filename=name, chunk=remaining.popleft(), content=content, codec=codec)
+
+            try:
+                if not self.pipeline(commands(), chunkSize, onResponse):
+                    break
+            finally:
+                if text is None:
+                    feed.release(chunkSize, remaining) # Left to the other workers
+            if len(corrupt) == 0:
                 return
-            if i == len(chunks) - 1 and response.content == f"File {name} received":
-                print(f"File {name} upload success")
-            
+            log(f"Resending {len(corrupt)} corrupt chunks of {name}")
+            chunks = corrupt
+        print(f"File {name} upload failed")
+
+
+    # Report the final upload response, including how far the replication chain got
+    def uploaded(self, response: Response):
+        name = self.userCommand.filename
+        replicated, unreplicated = response.option("replicated"), response.option("unreplicated")
+        print(f"File {name} upload success{f", replicated to {replicated.replace(",", " ")}" if replicated is not None else ""}")
+        if unreplicated is not None:
+            print(f"File {name} replication to {unreplicated.replace(",", " ")} failed")
+        self.succeeded = unreplicated is None and (self.userCommand.replicate is None or replicated is not None)
 
     def handleDownload(self):
         # Download intention declaration should already have been sent
         assert self.userCommand.type == CommandType.DOWNLOAD
         assert self.userCommand.filename is not None
         assert self.download is not None
-        if self.downloadChunkIds is None or len(self.downloadChunkIds) == 0:
-            log(f"Nothing to download from server {self.serverId}")
-            return
+        assert self.queue is not None
         name = self.userCommand.filename
-        for chunk in self.downloadChunkIds:
-            response = self.getResponse(Command(CommandType.DOWNLOAD, filename=name, chunk=chunk))
-            if response is None or not response.code.ok():
-                return error(f"File {name} download failed")
-            with downloadLock:
-                content = response.content
-                if content.endswith("\n"):
-                    content = content.splitlines()[0]
-                log(f"{content.split(" ", 4)}")
-                _, receivedFilename, _, receivedChunkNo, content = content.split(" ", 4)
-                receivedChunkNo = int(receivedChunkNo)
-                if receivedFilename != self.userCommand.filename or receivedChunkNo != chunk:
-                    return error("Received wrong file or chunk from server")
-                self.download.save(chunk, content)
-                if self.download.isComplete():
-                    self.download.writeToDisk()
-                    print(f"File {self.download.filename} download success")
-                    return
+        queue = self.queue
+
+        # key is the chunk no., or the offset for range responses
+        def onResponse(key: int, response: Response) -> bool:
+            if not response.code.ok():
+                return False
+            if response.offset is not None:
+                receivedFilename, receivedKey, content = response.filename, response.offset, response.data
+            elif response.data is not None:
+                receivedFilename, receivedKey, content = response.filename, response.chunk, response.data
+            else: # Text protocol
+                log(f"{response.content.split(" ", 4)[:4]}")
+                _, receivedFilename, _, receivedKey, content = response.content.split(" ", 4)
+                receivedKey = int(receivedKey)
+            if receivedFilename != self.userCommand.filename or receivedKey != key:
+                return error("Received wrong file, chunk or range from server")
+            if not queue.claim(key, self.serverId): # Re-issued to another peer which got there first
+                return True
+            chunkSize = self.download.chunkSize
+            offset = key if response.offset is not None else key * chunkSize
+            corrupt = self.download.corrupt(offset, content)
+            if len(corrupt) > 0:
+                # Keep the good chunks, fetch the bad ones again from the other peers
+                data = memoryview(toBytes(content))
+                for chunk in range(offset // chunkSize, noOfChunks(offset + len(data), chunkSize)):
+                    if chunk not in corrupt:
+                        self.download.save(chunk, data[chunk * chunkSize - offset:(chunk + 1) * chunkSize - offset])
+                queue.refetch(key, [(chunk * chunkSize if queue.ranges else chunk, min(chunkSize, self.download.size - chunk * chunkSize)) for chunk in corrupt])
+                return error(f"Server {self.serverId} sent corrupt chunks {corrupt} of {name}")
+            if not (self.download.saveRange(key, content) if response.offset is not None else self.download.save(key, content)):
+                queue.retry(key)
+                return False
+            self.download.complete()
+            return True
+
+        # Pull tasks from the shared queue as the window frees up, yielding None while only waiting on own requests
+        def commands() -> Iterable[Command | None]:
+            refreshed = taken = perf_counter()
+            while not queue.isFinished():
+                task = queue.take(self.serverId)
+                if task is None:
+                    if queue.holds(self.serverId) > 0:
+                        yield None
+                    elif queue.isPartial(self.serverId) and perf_counter() - taken > SWARM_PATIENCE:
+                        log(f"Server {self.serverId} holds nothing more of {name}, not downloading from it")
+                        return
+                    elif queue.isPartial(self.serverId) and perf_counter() - refreshed > AVAILABILITY_INTERVAL:
+                        if not self.refreshAvailability():
+                            return
+                        refreshed = perf_counter()
+                    else:
+                        queue.wait(self.serverId)
+                    continue
+                taken = perf_counter()
+                if queue.ranges:
+                    yield Command(CommandType.DOWNLOAD, filename=name, offset=task[0], length=task[1], codec=self.codec)
+                else:
+                    yield Command(CommandType.DOWNLOAD, filename=name, chunk=task[0], chunkSize=self.download.chunkSize if self.connection.binary else None, codec=self.codec if self.connection.binary else None)
+
+        try:
+            if not self.pipeline(commands(), queue.requestSize(), onResponse, queue.isFinished):
+                return error(f"Download of {name} from server {self.serverId} failed")
+        finally:
+            queue.abandon(self.serverId)
+
+    # Ask the peer, which is downloading the file too, what it holds by now. Only while no requests are in
+    # flight on the connection, which this also keeps from going idle
+    def refreshAvailability(self) -> bool:
+        if not self.connection.send(Command(CommandType.DOWNLOAD, filename=self.userCommand.filename, chunkSize=MAX_CHUNK_SIZE)):
+            self.connection.close()
+            return error(f"Could not send command to server {self.serverId}")
+        response = self.connection.receiveResponse()
+        if response is None:
+            self.connection.close()
+            return error(f"Could not receive response from server {self.serverId}")
+        if response.code.ready() and response.value("bytes") == self.download.size and response.option("digest") == self.download.digest:
+            self.queue.setAvailable(self.serverId, bytes.fromhex(response.option("have")) if response.option("have") is not None else None, response.value("chunksize"))
+        return True
 
     def handleDelete(self):
         assert self.userCommand.type == CommandType.DELETE
@@ -180,6 +787,7 @@ class ClientWorker(Thread):
             Command(CommandType.DELETE, filename=self.userCommand.filename))
         if response is None or not response.code.ok():
             return error(f"File {self.userCommand.filename} delete failed")
+        self.succeeded = True
         print(f"File {self.userCommand.filename} delete success")
 
     def run(self):
@@ -187,12 +795,23 @@ class ClientWorker(Thread):
             match self.userCommand.type:
                 case CommandType.FILELIST:
                     self.handleFilelist()
+                case CommandType.UPLOAD if self.userCommand.replicate is not None:
+                    # The last response only comes once the whole chain has the file
+                    timeout = self.connection.socket.gettimeout()
+                    self.connection.socket.settimeout(REPLICA_TIMEOUT * (len(self.userCommand.replicate) + 1))
+                    try:
+                        self.handleUpload()
+                    finally:
+                        if self.connection.socket.fileno() >= 0: # Unless closed after a failure
+                            self.connection.socket.settimeout(timeout)
                 case CommandType.UPLOAD:
                     self.handleUpload()
                 case CommandType.DOWNLOAD:
                     self.handleDownload()
                 case CommandType.DELETE:
                     self.handleDelete()
+                case CommandType.STATS:
+                    self.handleStats()
                 case _:
                     return error("Not implemented")
         except KeyboardInterrupt:
@@ -200,131 +819,456 @@ class ClientWorker(Thread):
 
     def join(self, timeout=None):
         super().join(timeout)
-        self.clientSocket.close()
-        log("Join ClientWorker, closed clientSocket")
+        self.pool.release(self.serverId, self.connection)
+        log("Join ClientWorker, released connection")
 
 
 class Client:
     servers: dict[str, tuple[str, int]]  # Map server ids to (addr, port)
-    download: PartialDownload | None
     id: str
+    windowSize: int
+    adaptiveWindow: bool
+    pool: ConnectionPool
+    codec: Codec | None # Compression to negotiate for transfers
 
     def __init__(self):
         global debug
-        if len(sys.argv) == 2 and sys.argv[1] == "debug":
+        if "debug" in sys.argv[1:]:
             debug = True
         self.servers = readSettings()
-        self.download = None
         self.id = parentFolderName()
+        window = argument("window") or "8"
+        self.adaptiveWindow = window == "auto"
+        self.windowSize = int(window) if not self.adaptiveWindow else 1
+        self.pool = ConnectionPool(self.servers, float(argument("keepalive") or KEEPALIVE_INTERVAL))
+        self.codec = Codec.fromString(argument("compress"))
 
-    def getResponse(self, command: Command, clientSocket: socket | None) -> Response | None:
-        if clientSocket is None:
-            return error("clientSocket is None in Client.getResponse()")
+    # Send command to serverId over a pooled connection, which goes back to the pool unless something failed
+    def getResponse(self, command: Command, serverId: str, connection: Connection | None) -> Response | None:
+        if connection is None:
+            return error("connection is None in Client.getResponse()")
+        log(f"Sending command: {command.toString()}")
+        if not connection.send(command):
+            connection.close()
+            return error("Could not send command in Client.getResponse()")
+        response = connection.receiveResponse()
+        if response is None:
+            connection.close()
+            return None
+        self.pool.release(serverId, connection)
+        return response
+
+    # Send the download intent to all peers at once, (id, response) pairs arrive on the returned queue
+    def probe(self, filename: str, peers: list[str]) -> SimpleQueue:
+        results = SimpleQueue()
+
+        def probeOne(id: str):
+            connection = self.pool.acquire(id)
+            binary = connection is not None and connection.binary
+            results.put((id, self.getResponse(Command(
+                type=CommandType.DOWNLOAD, filename=filename, chunkSize=MAX_CHUNK_SIZE if binary else None, codec=self.codec if binary else None), id, connection=connection)))
+
+        for id in peers:
+            Thread(target=probeOne, args=(id,), daemon=True).start()
+        return results
+
+    # Ready responses from the waiting peers, blocking until there is at least one or the deadline passes.
+    # Peers that answer without serving the file are added to declined
+    def collect(self, probes: SimpleQueue, waiting: set[str], deadline: float, declined: set[str]) -> list[tuple[str, Response]]:
+        ready: list[tuple[str, Response]] = []
+        while len(waiting) > 0:
+            timeout = deadline - perf_counter() if len(ready) == 0 else 0
+            try:
+                id, response = probes.get(timeout=timeout) if timeout > 0 else probes.get_nowait()
+            except Empty:
+                break
+            waiting.discard(id)
+            if response is not None and response.code.ready():
+                ready.append((id, response))
+            elif response is not None:
+                declined.add(id)
+        return ready
+
+    def canJoin(self, response: Response, queue: DownloadQueue, download: PartialDownload) -> bool:
+        if response.value("bytes") != download.size or response.option("digest") != download.digest:
+            return False
+        if queue.ranges:
+            return (response.value("maxrange") or 0) >= queue.requestSize()
+        if response.option("have") is not None: # Still downloading the file, serves byte ranges only
+            return False
+        return download.chunkSize == CHUNK_SIZE or (response.value("chunksize") or 0) >= download.chunkSize
+
+    def startWorker(self, serverId: str, userCommand: UserCommand, download: PartialDownload | None = None, queue: DownloadQueue | None = None, digest: tuple[str, list[str]] | None = None, codec: Codec | None = None, feed: ChunkFeed | None = None) -> ClientWorker | None:
         try:
-            log(f"Sending command: {command.toString()}")
-            clientSocket.send(command.toSafeString().encode())
-        except SocketError:
-            return error(f"Could not connect to {self.servers[id]}")
-        responseStr = ""
-        start = time_ns()
-        while not responseStr.endswith("\n"):
-            now = time_ns()
-            if now - start > 1E9:
-                return error("Timeout while receiving")
-            buffer = clientSocket.recv(1024)
-            if len(buffer) == 0:
-                return error(f"Server closed connection")
-            responseStr += buffer.decode()
-            sleep(0.01)
-        return Response.fromSafeString(responseStr)
+            worker = ClientWorker(kwargs={
+                "serverId": serverId,
+                "clientId": self.id,
+                "pool": self.pool,
+                "userCommand": userCommand,
+                "download": download,
+                "queue": queue,
+                "digest": digest,
+                "feed": feed,
+                "codec": codec,
+                "window": Window(self.windowSize, self.adaptiveWindow)
+            })
+        except (SocketError, ConnectionRefusedError, TimeoutError):
+            return None
+        worker.start()
+        return worker
 
-    def newSocket(self, server: tuple[str, int]) -> socket | None:
+    # Carry out one user command, e.g. "#DOWNLOAD f p1 p2", returning whether it went through on every peer.
+    # Commands may run concurrently, they only share the connection pool
+    def execute(self, commandStr: str) -> bool:
+        userCommand: UserCommand = UserCommand.fromString(commandStr)
+        if userCommand is None:
+            return False
+        assert userCommand is not None
+        log(f"Confirm userCommand: {userCommand.toString()}")
+        if userCommand.stripe is not None:
+            return self.uploadStriped(userCommand)
+        if userCommand.striped:
+            return self.downloadStriped(userCommand)
+
+        validPeers = userCommand.ids
+        download: PartialDownload | None = None
+        queue: DownloadQueue | None = None
+        digest: tuple[str, list[str]] | None = None # Of the file to upload
+        feed: ChunkFeed | None = None # Of the file to upload
+        probes: SimpleQueue | None = None # Download intent responses still to come
+        waiting: set[str] = set() # Peers yet to answer the download intent
+        declined: set[str] = set() # Peers that answered the download intent without serving the file
+        deadline = 0.0 # For download intent responses
+        codecs: dict[str, Codec | None] = dict() # Compression each download peer agreed to
+        if userCommand.type == CommandType.UPLOAD and userCommand.filename is not None:
+            if not exists(served(userCommand.filename)):
+                print(f"Peer {self.id} does not serve file {userCommand.filename}")
+                return False
+            print(f"Uploading {userCommand.filename}")
+            digest = fileIndex.digest(userCommand.filename) # Hashed once here rather than in every worker, while the connections wait
+            feed = ChunkFeed(served(userCommand.filename))
+        if userCommand.type == CommandType.DOWNLOAD and userCommand.filename is not None:
+            if exists(served(userCommand.filename)):
+                print(f"File {userCommand.filename} already exists")
+                return False
+            print(f"Downloading {userCommand.filename}")
+            deadline = perf_counter() + PROBE_TIMEOUT
+            probes = self.probe(userCommand.filename, validPeers)
+            waiting = set(validPeers)
+            # Start with whoever answered first, stragglers join later
+            responses = self.collect(probes, waiting, deadline, declined)
+            validPeers = []
+            if len(responses) > 0:
+                size, expectedDigest = responses[0][1].value("bytes"), responses[0][1].option("digest")
+                responses = [(id, response) for id, response in responses if response.value("bytes") == size and response.option("digest") == expectedDigest]
+                if any(response.value("maxrange") is None for _, response in responses): # Peers still downloading the file only serve byte ranges
+                    responses = [(id, response) for id, response in responses if response.option("have") is None]
+                manifests = [response.option("manifest") for _, response in responses if response.option("manifest") is not None]
+                chunkSizeLimits = [response.value("chunksize") for _, response in responses] # None for peers that do not negotiate chunk sizes
+                rangeSizeLimits = [response.value("maxrange") for _, response in responses] # None for peers that do not serve byte ranges
+                chunkSize = chooseChunkSize(size, min(chunkSizeLimits)) if None not in chunkSizeLimits else CHUNK_SIZE
+                # Peers that do not negotiate chunk sizes count the size and chunks in characters
+                download = PartialDownload(filename=userCommand.filename, size=size, chunkSize=chunkSize, digest=expectedDigest, hashes=manifests[0].split(",") if len(manifests) > 0 else None, legacy=None in chunkSizeLimits)
+                try:
+                    download.open()
+                except OSError as e:
+                    error(f"{e}")
+                    download.discard()
+                    download = None
+                else:
+                    validPeers = [id for id, _ in responses]
+                    codecs = {id: Codec.fromString(response.option("compress")) for id, response in responses}
+                    missing = download.missing() # Everything, unless resuming
+                    swarming = [(id, response) for id, response in responses if response.option("have") is not None]
+                    if None not in rangeSizeLimits:
+                        # A few ranges per peer, each spanning whole chunks so that the partial download can track them
+                        rangeSize = ceil(sum(length for _, length in missing) / (len(validPeers) * RANGES_PER_PEER) / chunkSize) * chunkSize
+                        rangeSize = max(min(rangeSize, min(rangeSizeLimits + [MAX_RANGE_SIZE]) // chunkSize * chunkSize), chunkSize)
+                        tasks = [(start + offset, length) for start, span in missing for offset, length in splitRanges(span, rangeSize)]
+                        if len(swarming) > 0 or len(declined) > 0:
+                            # Downloaders that started together take the ranges in different orders, so that they come to hold different
+                            # chunks. Peers still downloading the file carve single chunks they hold out of the ranges, see DownloadQueue.carve()
+                            shuffle(tasks)
+                        queue = DownloadQueue(tasks, ranges=True, chunkSize=chunkSize, noOfPeers=len(validPeers))
+                        for id, response in swarming:
+                            queue.setAvailable(id, bytes.fromhex(response.option("have")), response.value("chunksize"))
+                    else:
+                        queue = DownloadQueue([((start + offset) // chunkSize, length) for start, span in missing for offset, length in splitRanges(span, chunkSize)], ranges=False, chunkSize=chunkSize, noOfPeers=len(validPeers))
+                    download.complete() # Resumed with nothing missing
+                    log(f"Confirmed valid peers: {validPeers}, chunk size {chunkSize}{f", range size {queue.requestSize()}" if queue.ranges else ""}{f", swarming with {[id for id, _ in swarming]}" if len(swarming) > 0 else ""}")
+
+        if len(validPeers) == 0:
+            print(f"File {userCommand.filename} {userCommand.type.toString().lower()} failed, peers {" ".join(userCommand.ids)} are not serving the file")
+            return False
+
+        workers = [worker for worker in (self.startWorker(serverId, userCommand, download, queue, digest, codecs.get(serverId, self.codec), feed) for serverId in validPeers) if worker is not None]
+        # Peers that answer the download intent late join the transfer, if they can serve the chunks or ranges already chosen
+        reprobed, interval = perf_counter(), REPROBE_INTERVAL
+        while queue is not None and not queue.isFinished() and any(worker.is_alive() for worker in workers):
+            if len(waiting) == 0 or perf_counter() >= deadline:
+                if not queue.ranges or len(declined) == 0:
+                    break
+                if perf_counter() - reprobed < interval:
+                    sleep(0.05)
+                    continue
+                # Peers that did not serve the file may have started downloading it since, and can serve the chunks they hold
+                waiting, declined = set(declined), set()
+                probes = self.probe(userCommand.filename, list(waiting))
+                deadline = perf_counter() + PROBE_TIMEOUT
+                reprobed, interval = perf_counter(), min(interval * 2, MAX_REPROBE_INTERVAL)
+            for id, response in self.collect(probes, waiting, min(deadline, perf_counter() + 0.05), declined):
+                if not self.canJoin(response, queue, download):
+                    log(f"Server {id} answered too late with different limits, not downloading from it")
+                    continue
+                queue.addPeer()
+                if response.option("have") is not None:
+                    queue.setAvailable(id, bytes.fromhex(response.option("have")), response.value("chunksize"))
+                worker = self.startWorker(id, userCommand, download, queue, codec=Codec.fromString(response.option("compress")))
+                if worker is not None:
+                    workers.append(worker)
+        for worker in workers:
+            worker.join()
+        if queue is not None:
+            log(f"Throughput: {", ".join(f"{id} {rate / 1e6:.1f}MB/s" for id, rate in queue.throughput.items())}")
+        if download is not None and not download.isComplete():
+            download.suspend() # Kept for a retry of the same download, if it has a digest
+            print(f"File {userCommand.filename} download failed")
+        if download is not None:
+            return download.succeeded
+        return len(workers) == len(validPeers) and all(worker.succeeded for worker in workers)
+
+    # Spread a file over k + m peers, by default the first ones in peer_settings.txt: k data shards, holding the
+    # file's blocks round robin, and m parity shards, any k of which are enough to rebuild it. Each shard is
+    # uploaded as an ordinary file "<name>.shard<i>" to its own peer, along with a manifest "<name>.stripe" to all
+    def uploadStriped(self, userCommand: UserCommand) -> bool:
+        name = userCommand.filename
+        k, m = userCommand.stripe
+        peers = userCommand.ids or [id for id in self.servers if id != self.id]
+        if k < 1 or m < 0 or k + m > 256 or len(peers) < k + m or userCommand.replicate is not None:
+            print(f"File {name} upload failed, cannot stripe over {k}+{m} of peers {" ".join(peers)}{" with replication" if userCommand.replicate is not None else ""}")
+            return False
+        if not exists(served(name)):
+            print(f"Peer {self.id} does not serve file {name}")
+            return False
+        print(f"Uploading {name} striped over {k}+{m} peers")
+        peers = peers[:k + m]
+        size = getsize(served(name))
+        blockSize = max(min(STRIPE_BLOCK_SIZE, ceil(size / k)), 1)
+        code = ErasureCode(k, m)
+        folder = tempfile.mkdtemp(prefix="stripe")
         try:
-            ret = socket(AF_INET, SOCK_STREAM)
-            ret.connect(server)
-            return ret
-        except (SocketError, ConnectionRefusedError):
-            return error(f"Could not connect to {server} in Client.newSocket")
+            paths = [os.path.join(folder, f"{name}{SHARD_SUFFIX}{i}") for i in range(k + m)]
+            hashes = [sha256() for _ in paths]
+            shards = [open(path, "wb") for path in paths]
+            try:
+                with open(served(name), "rb") as source:
+                    for _ in range(max(ceil(size / (k * blockSize)), 1)):
+                        row = source.read(k * blockSize).ljust(k * blockSize, b"\0") # The last row is padded
+                        blocks = [row[i * blockSize:(i + 1) * blockSize] for i in range(k)]
+                        for shard, hash, block in zip(shards, hashes, blocks + code.encode(blocks)):
+                            shard.write(block)
+                            hash.update(block)
+            finally:
+                for shard in shards:
+                    shard.close()
+            manifest = {
+                "size": size,
+                "digest": (fileIndex.digest(name) or (None, None))[0],
+                "k": k,
+                "m": m,
+                "blockSize": blockSize,
+                "shards": [{"name": os.path.basename(path), "peer": peer, "digest": hash.hexdigest()} for path, peer, hash in zip(paths, peers, hashes)]
+            }
+            with open(os.path.join(folder, f"{name}{STRIPE_SUFFIX}"), "w") as f:
+                json.dump(manifest, f)
+            uploads = [(peer, path) for peer, path in zip(peers, paths)] + [(peer, os.path.join(folder, f"{name}{STRIPE_SUFFIX}")) for peer in peers]
+            workers = [self.startWorker(peer, UserCommand(CommandType.UPLOAD, [peer], os.path.basename(path)), digest=fileDigest(path), feed=ChunkFeed(path)) for peer, path in uploads]
+            for worker in workers:
+                if worker is not None:
+                    worker.join()
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+        succeeded = all(worker is not None and worker.succeeded for worker in workers)
+        print(f"File {name} striped upload {"success" if succeeded else "failed"}")
+        return succeeded
+
+    # Fetch the whole of filename from serverId into path with byte range requests, checking its sha256 against
+    # digest if given. Stops early once cancelled is set
+    def fetch(self, serverId: str, filename: str, path: str, digest: str | None, cancelled: Event) -> bool:
+        connection = self.pool.acquire(serverId)
+        if connection is None:
+            return error(f"Could not connect to server {serverId}")
+
+        def request(command: Command) -> Response | None:
+            if not connection.send(command):
+                return None
+            return connection.receiveResponse()
+
+        try:
+            response = request(Command(CommandType.DOWNLOAD, filename=filename, chunkSize=MAX_CHUNK_SIZE)) if connection.binary else None
+            if response is None or not response.code.ready() or response.option("have") is not None:
+                return error(f"Server {serverId} is not serving {filename} in byte ranges")
+            size, rangeSize = response.value("bytes"), min(response.value("maxrange") or MAX_RANGE_SIZE, STRIPE_RANGE_SIZE)
+            hash = sha256()
+            with open(path, "wb") as f:
+                while f.tell() < size and not cancelled.is_set():
+                    offset = f.tell()
+                    response = request(Command(CommandType.DOWNLOAD, filename=filename, offset=offset, length=min(rangeSize, size - offset)))
+                    if response is None or not response.code.ok() or response.offset != offset or len(response.data or b"") == 0:
+                        return error(f"Could not fetch {filename} range {offset} from server {serverId}")
+                    f.write(response.data)
+                    hash.update(response.data)
+                return f.tell() == size and (digest is None or hash.hexdigest() == digest)
+        except OSError as e:
+            return error(f"{e}")
+        finally:
+            self.pool.release(serverId, connection) # Closed instead unless idle and alive
+
+    # Rebuild a file striped by uploadStriped() from the first k of its shards to arrive
+    def downloadStriped(self, userCommand: UserCommand) -> bool:
+        name = userCommand.filename
+        peers = userCommand.ids or [id for id in self.servers if id != self.id]
+        if exists(served(name)):
+            print(f"File {name} already exists")
+            return False
+        print(f"Downloading {name} from its shards")
+        folder = tempfile.mkdtemp(prefix="stripe")
+        cancelled = Event()
+        try:
+            manifest = None
+            for id in peers:
+                if self.fetch(id, f"{name}{STRIPE_SUFFIX}", os.path.join(folder, f"{name}{STRIPE_SUFFIX}"), None, cancelled):
+                    try:
+                        with open(os.path.join(folder, f"{name}{STRIPE_SUFFIX}")) as f:
+                            manifest = json.load(f)
+                        break
+                    except (OSError, ValueError):
+                        continue
+            if manifest is None:
+                print(f"File {name} download failed, peers {" ".join(peers)} hold no stripe of it")
+                return False
+            size, k, m, blockSize, shards = manifest["size"], manifest["k"], manifest["m"], manifest["blockSize"], manifest["shards"]
+            fetched: list[int] = [] # Shard nos. fetched and checked
+            finished = [0]
+            condition = Condition()
+
+            # All shards at once, so that slow or dead peers do not hold up the first k
+            def fetchShard(i: int):
+                ok = self.fetch(shards[i]["peer"], shards[i]["name"], os.path.join(folder, shards[i]["name"]), shards[i]["digest"], cancelled)
+                with condition:
+                    if ok:
+                        fetched.append(i)
+                    finished[0] += 1
+                    condition.notify_all()
+
+            threads = [Thread(target=fetchShard, args=(i,), daemon=True) for i in range(k + m)]
+            for thread in threads:
+                thread.start()
+            with condition:
+                while len(fetched) < k and finished[0] < k + m:
+                    condition.wait()
+                available = sorted(fetched)[:k] # Data shards first, they need no decoding
+            cancelled.set()
+            for thread in threads:
+                thread.join()
+            if len(available) < k:
+                print(f"File {name} download failed, only {len(available)} of the {k} shards needed arrived")
+                return False
+            log(f"Rebuilding {name} from shards {available}")
+            code = ErasureCode(k, m)
+            decoder = code.decoder(available)
+            sources = [open(os.path.join(folder, shards[i]["name"]), "rb") for i in available]
+            try:
+                with open(partial(name), "wb") as f:
+                    while f.tell() < size:
+                        blocks = [source.read(blockSize) for source in sources]
+                        row = b"".join(blocks[available.index(i)] if i in available else code.combine(decoder[i], blocks) for i in range(k))
+                        f.write(row[:size - f.tell()])
+            finally:
+                for source in sources:
+                    source.close()
+            if manifest["digest"] is not None and fileDigest(partial(name))[0] != manifest["digest"]:
+                os.remove(partial(name))
+                print(f"File {name} download failed, content does not match its digest")
+                return False
+            os.replace(partial(name), served(name))
+        except (OSError, KeyError, TypeError, ValueError) as e:
+            error(f"{e}")
+            print(f"File {name} download failed")
+            return False
+        finally:
+            cancelled.set()
+            shutil.rmtree(folder, ignore_errors=True)
+        print(f"File {name} download success")
+        return True
+
+    # Run the commands in source, a file or "-" for stdin, up to concurrency at a time. Lines are either
+    # commands as typed at the prompt or JSON objects such as {"id": 7, "command": "#UPLOAD f p1 p2"} or
+    # {"type": "upload", "filename": "f", "peers": ["p1", "p2"]}. Each result is reported on stdout as a
+    # JSON line, in order of completion; everything the commands print goes to stderr instead
+    def batch(self, source: str, concurrency: int = BATCH_CONCURRENCY):
+        results = sys.stdout
+        sys.stdout = sys.stderr
+        resultsLock = RLock()
+        slots = BoundedSemaphore(concurrency) # Read ahead only as far as there is room to run
+        started = perf_counter()
+
+        def report(result: dict):
+            with resultsLock:
+                results.write(json.dumps(result) + "\n")
+                results.flush()
+
+        def runOne(lineNo: int, entry: dict):
+            try:
+                commandStr = entry.get("command") or f"#{entry["type"].upper()} {entry.get("filename") or ""} {" ".join(entry.get("peers") or [])}"
+                start = perf_counter()
+                ok = self.execute(" ".join(commandStr.split()))
+                report({"line": lineNo, **({"id": entry["id"]} if "id" in entry else {}), "command": commandStr, "ok": ok, "start": round(start - started, 3), "ms": round((perf_counter() - start) * 1000, 3)})
+            except Exception as e: # One bad line must not stop the rest of the batch
+                report({"line": lineNo, **({"id": entry["id"]} if "id" in entry else {}), "ok": False, "error": f"{type(e).__name__}: {e}"})
+            finally:
+                slots.release()
+
+        file = sys.stdin if source == "-" else open(source)
+        try:
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                for lineNo, line in enumerate(file, 1):
+                    line = line.strip()
+                    if len(line) == 0:
+                        continue
+                    try:
+                        entry = json.loads(line) if line.startswith("{") else {"command": line}
+                    except json.JSONDecodeError as e:
+                        report({"line": lineNo, "ok": False, "error": f"Invalid JSON: {e}"})
+                        continue
+                    if not isinstance(entry, dict):
+                        report({"line": lineNo, "ok": False, "error": "Not a JSON object"})
+                        continue
+                    slots.acquire()
+                    executor.submit(runOne, lineNo, entry)
+        finally:
+            if file is not sys.stdin:
+                file.close()
+            sys.stdout = results
+            self.pool.close()
 
     def run(self):
         while True:
             commandStr = input("Input your command: ")
             if commandStr == "q":
+                self.pool.close()
                 return
             elif commandStr == "clear":
                 os.system('clear' if os.name == 'posix' else 'cls')
                 continue
-            userCommand: UserCommand = UserCommand.fromString(commandStr)
-            if userCommand is None:
-                continue
-            assert userCommand is not None
-            log(f"Confirm userCommand: {userCommand.toString()}")
-
-            validPeers = userCommand.ids
-            downloadResponse: Response | None = None
-            noOfChunks = 0
-            if userCommand.type == CommandType.UPLOAD and userCommand.filename is not None:
-                if not exists(served(userCommand.filename)):
-                    print(f"Peer {self.id} does not serve file {userCommand.filename}")
-                    continue
-                print(f"Uploading {userCommand.filename}")
-            if userCommand.type == CommandType.DOWNLOAD and userCommand.filename is not None:
-                if exists(served(userCommand.filename)):
-                    print(f"File {userCommand.filename} already exists")
-                    continue
-                print(f"Downloading {userCommand.filename}")
-                for id in validPeers:
-                    clientSocket = self.newSocket(self.servers[id])
-                    downloadResponse = self.getResponse(Command(
-                        type=CommandType.DOWNLOAD, filename=userCommand.filename), clientSocket=clientSocket)
-                    if downloadResponse is None or not downloadResponse.code.ready():
-                        validPeers.remove(id)
-                        continue
-                    size = int(downloadResponse.content.split("bytes ")[1])
-                    self.download = PartialDownload(filename=userCommand.filename, size=size)
-                    noOfChunks = ceil(float(size) / 100.0)
-                    if clientSocket is not None:
-                        clientSocket.close()
-                log(f"Confirmed valid peers: {validPeers}")
-
-            if len(validPeers) == 0:
-                print(f"File {userCommand.filename} {userCommand.type.toString().lower()} failed, peers {" ".join(userCommand.ids)} are not serving the file")
-                continue
-
-            workers: list[ClientWorker] = []
-
-            workerConfigs = [
-                {
-                    "serverId": serverId,
-                    "clientId": self.id,
-                    "server": self.servers[serverId],
-                    "userCommand": userCommand,
-                    "download": self.download,
-                    "downloadChunkIds": [] if userCommand.type == CommandType.DOWNLOAD else None
-                } for serverId in validPeers
-            ]
-            if userCommand.type == CommandType.DOWNLOAD:
-                for chunk in range(noOfChunks):
-                    config = workerConfigs[chunk % len(workerConfigs)]
-                    assert config["downloadChunkIds"] is not None
-                    config["downloadChunkIds"].append(chunk)
-            for config in workerConfigs:
-                try:
-                    worker = ClientWorker(
-                        kwargs=config)
-                    workers.append(worker)
-                    worker.start()
-                except (SocketError, ConnectionRefusedError, TimeoutError):
-                    continue
-            for worker in workers:
-                worker.join()
-            if self.download is not None and not self.download.isComplete():
-                print(f"File {userCommand.filename} download failed")
-            self.download = None
+            self.execute(commandStr)
 
 
 if __name__ == "__main__":
     try:
-        Client().run()
+        if argument("batch") is not None: # client.py batch <file or -> [concurrency K]
+            Client().batch(argument("batch"), int(argument("concurrency") or BATCH_CONCURRENCY))
+        else:
+            Client().run()
     except KeyboardInterrupt:
         exit()
@@ -1,18 +1,63 @@
 from socket import *
-from threading import Thread, RLock
+from threading import Thread, RLock, Lock, Condition
 import sys
-from os import listdir
-from os.path import exists, isfile
+import os
+from os.path import exists
+from stat import S_ISREG
+from collections import OrderedDict
+from contextlib import contextmanager
 from enum import Enum
 from pathlib import Path
 from math import ceil
+from hashlib import sha256
+import shutil
+import json
+from time import monotonic, sleep, perf_counter
+from fnmatch import fnmatch
+import struct
+import signal
+import zlib
+import lzma
+from select import select
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import quote, unquote
-from time import sleep, time_ns
+try:
+    import fcntl
+except ImportError: # Windows, where the server runs a single process and needs no claims
+    fcntl = None
 
 debug = False
 
 uploadsLock = RLock()
 
+CHUNK_SIZE = 100 # bytes, used with peers that do not negotiate a chunk size
+MIN_CHUNK_SIZE = 64 * 1024 # bytes
+MAX_CHUNK_SIZE = 8 * 1024 * 1024 # bytes, advertised to clients as the largest chunk size served
+MAX_RANGE_SIZE = 64 * 1024 * 1024 # bytes, advertised to clients as the longest byte range served in one response
+MAX_LINE_SIZE = 4 * MAX_CHUNK_SIZE # bytes of the longest text message accepted, e.g. a quoted text protocol chunk or the intent carrying a huge file's manifest
+MAX_FRAME_SIZE = MAX_RANGE_SIZE + MAX_LINE_SIZE # bytes of the longest frame payload accepted, checked before anything is allocated for it
+
+IDLE_TIMEOUT = 0.5 # s a server connection may sit idle before it is closed
+UPLOAD_IDLE_TIMEOUT = 10 # s a connection with an upload in progress may wait for the next chunk, e.g. one the upstream peer of a replication chain is still receiving
+REPLICA_TIMEOUT = 10 # s the next peer of a replication chain gets to answer
+STATE_INTERVAL = 0.5 # s between saves of a partial file's state while chunks are arriving
+RESCAN_INTERVAL = 1 # s between checks of served_files/ for files changed by something other than this server
+STATS_INTERVAL = 10 # s between dumps of the stats file, if any
+CACHE_BUDGET = 64 * 1024 * 1024 # bytes of served file content kept in memory, unless configured otherwise
+CACHE_BLOCK_SIZE = 256 * 1024 # bytes
+HISTOGRAM_BUCKETS = 32 # Latency bucket b counts commands that took [2^(b-1), 2^b) µs
+
+PROTOCOL_VERSION = 2
+FRAME = struct.Struct("!BBHQI") # opcode, flags, filename length, offset, payload length
+FLAG_CHUNK = 0x01 # Offset is a chunk no. and the payload is raw chunk content; otherwise the payload is the text form
+FLAG_RANGE = 0x02 # Offset is a byte offset and the payload is raw file content
+FLAG_ZLIB = 0x04 # Raw payload is zlib compressed
+FLAG_LZMA = 0x08 # Raw payload is lzma compressed
+
+COMPRESSION_SAMPLE = 64 * 1024 # bytes of a chunk compressed to decide whether the rest is worth it in auto mode
+COMPRESSION_RATIO = 0.9 # a sample must shrink below this to be worth compressing
+
 def error(message: str) -> None:
     global debug
     if debug:
@@ -24,6 +69,13 @@ def log(message: str):
     if debug:
         print(message, end="" if message.endswith("\n") else "\n")
 
+# Value following name on the command line, e.g. argument("window") is "8" for "client.py debug window 8"
+def argument(name: str) -> str | None:
+    args = sys.argv[1:]
+    if name in args and args.index(name) + 1 < len(args):
+        return args[args.index(name) + 1]
+    return None
+
 def path(path: str) -> str:
     return (Path(__file__).parent / path).resolve().as_posix()
 
@@ -33,23 +85,158 @@ def parentFolderName() -> str:
 def served(filename: str) -> str:
     return path(f"served_files/{filename}")
 
+PARTIAL_SUFFIX = ".partial"
+STATE_SUFFIX = ".state"
+CLAIM_SUFFIX = ".claim"
+DIGESTS_FOLDER = ".digests" # In served_files/, never listed or served as it is no regular file
+
+# Where an upload is written until it is complete; never listed or served
+def partial(filename: str) -> str:
+    return served(f"{filename}{PARTIAL_SUFFIX}")
+
+# Sidecar of partial(filename) recording which chunks it holds, so that the transfer can be resumed
+def partialState(filename: str) -> str:
+    return served(f"{filename}{PARTIAL_SUFFIX}{STATE_SUFFIX}")
+
+# Lock file held by the worker process receiving filename, see PartialUpload.claim()
+def partialClaim(filename: str) -> str:
+    return served(f"{filename}{PARTIAL_SUFFIX}{CLAIM_SUFFIX}")
+
+# Digest of a served file computed by one worker process, for the others, see FileIndex.indexed()
+def digestSidecar(filename: str) -> str:
+    return served(f"{DIGESTS_FOLDER}/{filename}.json")
+
+def isPartial(filename: str) -> bool:
+    return filename.endswith(PARTIAL_SUFFIX) or filename.endswith(f"{PARTIAL_SUFFIX}{STATE_SUFFIX}") or filename.endswith(f"{PARTIAL_SUFFIX}{CLAIM_SUFFIX}")
+
 def getsize(path: str) -> int:
-    with open(path, 'r') as f:
-        return len(f.read())
-
-# https://severance.wiki/severance_procedure
-def sever(filepath: str) -> list[str]:
-    chunks: list[str] = []
-    with open(filepath, 'r') as f:
-        chunk = f.read(100)
-        while chunk: #loop until the chunk is empty (the file is exhausted)
-            chunks.append(chunk)
-            chunk = f.read(100) #read the next chunk
-    return chunks
-
-# https://severance.wiki/reintegration
-def reintegrate(packets: list[str]) -> str | None:
-    return "".join(packets)
+    return os.path.getsize(path)
+
+# Bytes an upload of filename may take on disk, counting a partial file it could resume into
+def freeSpace(filename: str) -> int:
+    try:
+        free = shutil.disk_usage(served("")).free
+    except OSError:
+        return 0
+    try:
+        return free + getsize(partial(filename))
+    except OSError:
+        return free
+
+# File content travels as str over the text protocol and as raw bytes over protocol v2. Bytes that are
+# not valid UTF-8 (including multi-byte characters split across a chunk boundary) are smuggled through
+# the text protocol as surrogates and restored exactly by toBytes().
+def toText(content: str | bytes | bytearray) -> str:
+    return content if isinstance(content, str) else content.decode("utf-8", "surrogateescape")
+
+def toBytes(content: str | bytes | bytearray) -> bytes | bytearray:
+    return content.encode("utf-8", "surrogateescape") if isinstance(content, str) else content
+
+# The file as text, cut into chunks of CHUNK_SIZE characters as peers that do not negotiate chunk sizes expect
+def textChunks(path: str) -> list[str]:
+    with open(path, encoding="utf-8", errors="surrogateescape", newline="") as f:
+        return list(iter(lambda: f.read(CHUNK_SIZE), ""))
+
+# Compression negotiated for a transfer: "zlib", "zlib:<level>", "lzma", "lzma:<preset>", or "auto" for zlib
+# that is skipped for chunks whose sample does not shrink. Whatever the mode, a chunk that does not shrink
+# is sent as is, so the receiver goes by the frame flags and needs no state
+class Codec:
+    name: str
+    level: int | None
+    auto: bool
+
+    def __init__(self, name: str, level: int | None = None, auto: bool = False):
+        self.name = name
+        self.level = level
+        self.auto = auto
+
+    def fromString(codec: str | None) -> "Codec | None":
+        if codec is None:
+            return None
+        if codec == "auto":
+            return Codec("zlib", auto=True)
+        name, _, level = codec.partition(":")
+        if name not in ("zlib", "lzma") or (level != "" and not (level.isdigit() and 0 <= int(level) <= 9)):
+            return error(f"Unsupported compression {codec}")
+        return Codec(name, int(level) if level != "" else None)
+
+    def toString(self) -> str:
+        return "auto" if self.auto else f"{self.name}{f":{self.level}" if self.level is not None else ""}"
+
+    def worthwhile(self, sample: bytes | bytearray | memoryview) -> bool:
+        return not self.auto or len(sample) == 0 or len(zlib.compress(sample, 1)) < len(sample) * COMPRESSION_RATIO
+
+    # (payload, flag) of the data to send
+    def compress(self, data: bytes | bytearray) -> tuple[bytes | bytearray, int]:
+        if not self.worthwhile(memoryview(data)[:COMPRESSION_SAMPLE]):
+            return data, 0
+        if self.name == "zlib":
+            compressed, flag = zlib.compress(data, self.level if self.level is not None else -1), FLAG_ZLIB
+        else:
+            compressed, flag = lzma.compress(data, preset=self.level), FLAG_LZMA
+        return (compressed, flag) if len(compressed) < len(data) else (data, 0)
+
+# Undo Codec.compress() according to the frame flags, refusing payloads that expand beyond limit bytes
+def decompress(payload: bytes | bytearray, flags: int, limit: int = MAX_RANGE_SIZE) -> bytes | bytearray | None:
+    try:
+        if flags & FLAG_ZLIB:
+            decompressor = zlib.decompressobj()
+            data = decompressor.decompress(payload, limit)
+            complete = decompressor.eof and len(decompressor.unconsumed_tail) == 0
+        elif flags & FLAG_LZMA:
+            decompressor = lzma.LZMADecompressor()
+            data = decompressor.decompress(payload, limit)
+            complete = decompressor.eof
+        else:
+            return payload
+    except (zlib.error, lzma.LZMAError) as e:
+        return error(f"Invalid compressed payload: {e}")
+    if not complete:
+        return error("Compressed payload is truncated or too large")
+    return data
+
+def chooseChunkSize(size: int, limit: int = MAX_CHUNK_SIZE) -> int:
+    # Aim for around 64 chunks per file, as a power of two between MIN_CHUNK_SIZE and limit
+    chunkSize = MIN_CHUNK_SIZE
+    while chunkSize * 64 < size and chunkSize < MAX_CHUNK_SIZE:
+        chunkSize *= 2
+    return min(chunkSize, limit)
+
+def noOfChunks(size: int, chunkSize: int) -> int:
+    return ceil(float(size) / chunkSize)
+
+# Split size bytes into (offset, length) ranges of rangeSize bytes, the last one possibly shorter
+def splitRanges(size: int, rangeSize: int) -> list[tuple[int, int]]:
+    return [(offset, min(rangeSize, size - offset)) for offset in range(0, size, rangeSize)]
+
+# Parse "key 1 otherkey 2" into {"key": 1, "otherkey": 2}. Values of textKeys are kept as strings
+def parseOptions(options: str, textKeys: tuple[str, ...] = ()) -> dict[str, int | str] | None:
+    components = options.split()
+    if len(components) % 2 != 0:
+        return error(f"Invalid options: {options}")
+    try:
+        return {components[i]: components[i + 1] if components[i] in textKeys else int(components[i + 1]) for i in range(0, len(components), 2)}
+    except ValueError:
+        return error(f"Invalid options: {options}")
+
+def chunkHash(content: str | bytes | bytearray) -> str:
+    return sha256(toBytes(content)).hexdigest()
+
+# Merkle-style: the file digest is the hash of its chunk hashes
+def rootHash(hashes: list[str]) -> str:
+    return sha256("".join(hashes).encode()).hexdigest()
+
+# (digest, chunk hashes) of the file at path. Chunks are always chooseChunkSize(size) long here, so that
+# the digest does not depend on what a transfer negotiates
+def fileDigest(path: str) -> tuple[str, list[str]]:
+    chunkSize = chooseChunkSize(getsize(path))
+    hashes: list[str] = []
+    with open(path, 'rb') as f:
+        chunk = f.read(chunkSize)
+        while chunk:
+            hashes.append(chunkHash(chunk))
+            chunk = f.read(chunkSize)
+    return rootHash(hashes), hashes
 
 def readSettings() -> dict[str, tuple[str, int]]:
     settings = dict()
@@ -63,44 +250,716 @@ def readSettings() -> dict[str, tuple[str, int]]:
     return settings
 
 
-class PartialUpload:
+class OpenFile:
+    path: str
+    fd: int
+    mtime: int # ns
+    size: int # bytes
+    users: int # Readers currently holding the fd
+    stale: bool # Evicted from the cache, close once the last reader releases it
+    lock: RLock
+
+    def __init__(self, path: str):
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+        stat = os.fstat(self.fd)
+        self.mtime = stat.st_mtime_ns
+        self.size = stat.st_size
+        self.users = 0
+        self.stale = False
+        self.lock = RLock()
+
+    def read(self, offset: int, length: int) -> bytes:
+        if hasattr(os, "pread"):
+            return os.pread(self.fd, length, offset)
+        with self.lock: # No positional reads on this platform, serialise seek + read instead
+            os.lseek(self.fd, offset, os.SEEK_SET)
+            return os.read(self.fd, length)
+
+    def close(self):
+        os.close(self.fd)
+
+
+# File-like view of an OpenFile for socket.sendfile(), which sends from the shared fd, or reads through the view
+# at its own position if the kernel cannot send the file. Neither moves the offset of the fd
+class FileStream:
+    file: OpenFile
+    position: int
+
+    def __init__(self, file: OpenFile):
+        self.file = file
+        self.position = 0
+
+    def fileno(self) -> int:
+        return self.file.fd
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        self.position = offset if whence == os.SEEK_SET else self.position + offset if whence == os.SEEK_CUR else self.file.size + offset
+        return self.position
+
+    def tell(self) -> int:
+        return self.position
+
+    def read(self, length: int) -> bytes:
+        data = self.file.read(self.position, length)
+        self.position += len(data)
+        return data
+
+
+class ChunkReader:
+    capacity: int # Max no. of open files kept around
+    files: OrderedDict[str, OpenFile] # Map path to open file, least recently used first
+    lock: RLock
+
+    def __init__(self, capacity: int = 16):
+        self.capacity = capacity
+        self.files = OrderedDict()
+        self.lock = RLock()
+
+    @contextmanager
+    def open(self, path: str):
+        stat = os.stat(path)
+        with self.lock:
+            file = self.files.get(path)
+            if file is not None and (file.mtime != stat.st_mtime_ns or file.size != stat.st_size):
+                self.discard(path)
+                file = None
+            if file is None:
+                file = OpenFile(path)
+                self.files[path] = file
+                while len(self.files) > self.capacity:
+                    self.discard(next(iter(self.files)))
+            self.files.move_to_end(path)
+            file.users += 1
+        try:
+            yield file
+        finally:
+            with self.lock:
+                file.users -= 1
+                if file.stale and file.users == 0:
+                    file.close()
+
+    def discard(self, path: str):
+        with self.lock:
+            file = self.files.pop(path, None)
+            if file is None:
+                return
+            file.stale = True
+            if file.users == 0:
+                file.close()
+
+    def read(self, path: str, offset: int, length: int) -> bytes:
+        with self.open(path) as file:
+            return file.read(offset, length)
+
+    def readChunk(self, path: str, chunk: int, chunkSize: int = CHUNK_SIZE) -> bytes:
+        return self.read(path, chunk * chunkSize, chunkSize)
+
+chunkReader = ChunkReader()
+
+
+# Blocks of served files kept in memory within a byte budget, so that downloads of hot files do not go back to
+# the disk. A block is only cached the second time it is asked for, so that a file downloaded once does not push
+# the hot ones out. Keys carry the mtime, so a replaced file never hits the old content
+class BlockCache:
+    budget: int # bytes
+    blocks: OrderedDict[tuple[str, int, int], bytes] # Map (filename, mtime, block no.) to content, least recently used first
+    seen: OrderedDict[tuple[str, int, int], None] # Blocks asked for once but not cached, least recently asked first
+    size: int # bytes cached
+    hits: int # Blocks served from memory
+    misses: int
+    evictions: int
+    lock: Lock
+
+    def __init__(self, budget: int = CACHE_BUDGET):
+        self.budget = budget
+        self.blocks = OrderedDict()
+        self.seen = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = Lock()
+
+    # Content of the byte range of a served file with the given mtime, or None if part of it is not hot yet and
+    # the caller had better send it straight from the file
+    def read(self, filename: str, mtime: int, offset: int, length: int) -> bytes | None:
+        if self.budget < CACHE_BLOCK_SIZE or length <= 0:
+            return None
+        first = offset // CACHE_BLOCK_SIZE
+        keys = [(filename, mtime, block) for block in range(first, (offset + length - 1) // CACHE_BLOCK_SIZE + 1)]
+        cold = False
+        with self.lock:
+            blocks = [self.blocks.get(key) for key in keys]
+            for key, content in zip(keys, blocks):
+                if content is not None:
+                    self.blocks.move_to_end(key)
+                    self.hits += 1
+                    continue
+                self.misses += 1
+                if key not in self.seen:
+                    cold = True
+                self.seen[key] = None
+                self.seen.move_to_end(key)
+            while len(self.seen) > 2 * self.budget // CACHE_BLOCK_SIZE:
+                self.seen.popitem(last=False)
+        if cold:
+            return None
+        try:
+            with chunkReader.open(served(filename)) as file:
+                if file.mtime != mtime: # Changed since it was indexed
+                    return None
+                for i, key in enumerate(keys):
+                    if blocks[i] is None:
+                        blocks[i] = file.read(key[2] * CACHE_BLOCK_SIZE, CACHE_BLOCK_SIZE)
+                        self.add(key, blocks[i])
+        except OSError:
+            return None
+        start = offset - first * CACHE_BLOCK_SIZE
+        data = b"".join(blocks)
+        return data if start == 0 and len(data) == length else data[start:start + length]
+
+    def add(self, key: tuple[str, int, int], content: bytes):
+        with self.lock:
+            self.seen.pop(key, None)
+            if key in self.blocks:
+                return
+            self.blocks[key] = content
+            self.size += len(content)
+            while self.size > self.budget:
+                _, evicted = self.blocks.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    # Drop every block of filename, e.g. once it is deleted or a new upload of it completes
+    def discard(self, filename: str):
+        with self.lock:
+            for key in [key for key in self.blocks if key[0] == filename]:
+                self.size -= len(self.blocks.pop(key))
+            for key in [key for key in self.seen if key[0] == filename]:
+                self.seen.pop(key)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {"budget": self.budget, "bytes": self.size, "blocks": len(self.blocks), "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+blockCache = BlockCache()
+
+
+# What the index knows about a served file. The digest takes a full read, so it is only filled in when needed
+class ServedFile:
+    size: int
+    mtime: int # ns
+    digest: str | None
+    hashes: list[str] | None
+
+    def __init__(self, size: int, mtime: int, digest: str | None = None, hashes: list[str] | None = None):
+        self.size = size
+        self.mtime = mtime
+        self.digest = digest
+        self.hashes = hashes
+
+# Served files by name, so that listings and intents are a dict lookup rather than a directory walk.
+# Kept current by completed uploads and deletes, and by a periodic stat() rescan for files changed
+# behind the server's back
+class FileIndex:
+    files: dict[str, ServedFile]
+    scanned: bool
+    shared: bool # Other worker processes change served_files/ too, so lookups check the disk rather than wait for a rescan and digests go through sidecars
+    lock: RLock
+
+    def __init__(self):
+        self.files = dict()
+        self.scanned = False
+        self.shared = False
+        self.lock = RLock()
+
+    # Stat every served file, keeping the digests of those whose size and mtime did not change
+    def scan(self):
+        with self.lock:
+            files: dict[str, ServedFile] = dict()
+            try:
+                entries = list(os.scandir(path("served_files/")))
+            except OSError:
+                entries = []
+            for entry in entries:
+                try:
+                    if isPartial(entry.name) or not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                except OSError: # Removed meanwhile
+                    continue
+                known = self.files.get(entry.name)
+                if known is not None and (known.size, known.mtime) == (stat.st_size, stat.st_mtime_ns):
+                    files[entry.name] = known
+                else:
+                    files[entry.name] = ServedFile(stat.st_size, stat.st_mtime_ns)
+            for filename in self.files.keys() - files.keys(): # Removed behind the server's back
+                blockCache.discard(filename)
+            self.files = files
+            self.scanned = True
+        if self.shared: # Digests of files removed by whichever process
+            try:
+                sidecars = os.listdir(served(DIGESTS_FOLDER))
+            except OSError:
+                sidecars = []
+            for sidecar in sidecars:
+                if sidecar.removesuffix(".json") not in files and not sidecar.endswith(".tmp"):
+                    Path(served(f"{DIGESTS_FOLDER}/{sidecar}")).unlink(missing_ok=True)
+
+    # Rescan every RESCAN_INTERVAL, hashing new and changed files before an upload or download intent needs them
+    def watch(self):
+        while True:
+            self.scan()
+            for filename in self.names():
+                self.digest(filename)
+            sleep(RESCAN_INTERVAL)
+
+    def get(self, filename: str) -> ServedFile | None:
+        with self.lock:
+            if not self.scanned:
+                self.scan()
+            if not self.shared:
+                return self.files.get(filename)
+        return self.check(filename)
+
+    # Bring the entry of filename up to date with the disk, one stat instead of a rescan
+    def check(self, filename: str) -> ServedFile | None:
+        if isPartial(filename) or filename in ("", ".", "..") or "/" in filename or os.sep in filename: # Only what a scan would list
+            return None
+        try:
+            stat = os.stat(served(filename))
+            if not S_ISREG(stat.st_mode):
+                raise FileNotFoundError(filename)
+        except OSError:
+            self.discard(filename)
+            return None
+        with self.lock:
+            file = self.files.get(filename)
+            if file is None or (file.size, file.mtime) != (stat.st_size, stat.st_mtime_ns):
+                file = self.files[filename] = ServedFile(stat.st_size, stat.st_mtime_ns)
+            return file
+
+    def names(self) -> list[str]:
+        with self.lock:
+            if not self.scanned:
+                self.scan()
+            return sorted(self.files.keys())
+
+    # A page of (filename, size) matching the glob pattern, and the total no. of matches
+    def listing(self, pattern: str | None = None, offset: int = 0, limit: int | None = None) -> tuple[list[tuple[str, int]], int]:
+        if self.shared:
+            self.scan()
+        with self.lock:
+            matches = [(filename, self.files[filename].size) for filename in self.names() if pattern is None or fnmatch(filename, pattern)]
+        return matches[offset:offset + limit if limit is not None else None], len(matches)
+
+    def add(self, filename: str, digest: str | None = None, hashes: list[str] | None = None, stat: os.stat_result | None = None):
+        try:
+            stat = stat or os.stat(served(filename))
+        except OSError:
+            return
+        with self.lock:
+            self.files[filename] = ServedFile(stat.st_size, stat.st_mtime_ns, digest, hashes)
+        if self.shared and digest is not None:
+            self.saveDigest(filename, self.files[filename])
+
+    def discard(self, filename: str):
+        with self.lock:
+            known = self.files.pop(filename, None)
+        if self.shared and known is not None:
+            Path(digestSidecar(filename)).unlink(missing_ok=True)
+
+    # Share a digest with the other worker processes, so that each file is hashed by one of them only
+    def saveDigest(self, filename: str, file: ServedFile):
+        try:
+            os.makedirs(served(DIGESTS_FOLDER), exist_ok=True)
+            with open(f"{digestSidecar(filename)}.{os.getpid()}.tmp", "w") as f:
+                json.dump({"size": file.size, "mtime": file.mtime, "digest": file.digest, "hashes": file.hashes}, f)
+            os.replace(f"{digestSidecar(filename)}.{os.getpid()}.tmp", digestSidecar(filename))
+        except OSError as e:
+            error(f"{e}")
+
+    # A digest another worker process computed for the file as it is now, if any
+    def loadDigest(self, filename: str, stat: os.stat_result) -> ServedFile | None:
+        try:
+            with open(digestSidecar(filename)) as f:
+                saved = json.load(f)
+            if (saved["size"], saved["mtime"]) != (stat.st_size, stat.st_mtime_ns) or saved["digest"] is None:
+                return None
+            file = ServedFile(stat.st_size, stat.st_mtime_ns, saved["digest"], saved["hashes"])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        with self.lock:
+            self.files[filename] = file
+        return file
+
+    # (digest, chunk hashes) of a served file, hashed again only if it changed since
+    def digest(self, filename: str) -> tuple[str, list[str]] | None:
+        try:
+            stat = os.stat(served(filename))
+            indexed = self.indexed(filename, stat)
+            if indexed is not None:
+                return indexed
+            digest, hashes = fileDigest(served(filename)) # Outside the lock, this reads the whole file
+        except OSError:
+            return None
+        self.add(filename, digest, hashes, stat)
+        return digest, hashes
+
+    # (digest, chunk hashes) of a served file if already hashed and unchanged since, without reading it. Requests
+    # must not wait for a multi-GB file to be hashed, they go without until the watcher gets to it
+    def indexed(self, filename: str, stat: os.stat_result | None = None) -> tuple[str, list[str]] | None:
+        try:
+            stat = stat or os.stat(served(filename))
+        except OSError:
+            return None
+        with self.lock:
+            file = self.files.get(filename)
+        if file is None or file.digest is None or (file.size, file.mtime) != (stat.st_size, stat.st_mtime_ns):
+            file = self.loadDigest(filename, stat) if self.shared else None
+            if file is None:
+                return None
+        return file.digest, file.hashes
+
+    # A served file with this digest and size, if any. Only digests already computed are compared
+    def find(self, digest: str, size: int) -> str | None:
+        with self.lock:
+            candidates = [filename for filename in self.names() if self.files[filename].size == size]
+        for candidate in candidates:
+            indexed = self.indexed(candidate)
+            if indexed is not None and indexed[0] == digest:
+                return candidate
+        return None
+
+fileIndex = FileIndex()
+
+
+# Chunks of a file still being received, read back from the state sidecar so that they can be served to
+# swarming peers. Only transfers checked chunk by chunk against a manifest qualify; the state lags the
+# partial file by up to STATE_INTERVAL, so every chunk it lists has been written
+class HeldFile:
+    filename: str
+    size: int # bytes
+    chunkSize: int # bytes
+    digest: str
+    hashes: list[str]
+    received: bytes # Bitmap of chunks held
+
+    def __init__(self, filename: str, size: int, chunkSize: int, digest: str, hashes: list[str], received: bytes):
+        self.filename = filename
+        self.size = size
+        self.chunkSize = chunkSize
+        self.digest = digest
+        self.hashes = hashes
+        self.received = received
+
+    @staticmethod
+    def load(filename: str) -> "HeldFile | None":
+        if isPartial(filename):
+            return None
+        try:
+            with open(partialState(filename)) as f:
+                state = json.load(f)
+            if state.get("hashes") is None or getsize(partial(filename)) != state["size"]:
+                return None
+            return HeldFile(filename, state["size"], state["chunkSize"], state["digest"], state["hashes"], bytes.fromhex(state["received"]))
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def holds(self, offset: int, length: int) -> bool:
+        if length == 0:
+            return True
+        return all(self.received[chunk // 8] >> (chunk % 8) & 1 for chunk in range(offset // self.chunkSize, (offset + length - 1) // self.chunkSize + 1))
+
+
+# A file being received chunk by chunk into a preallocated partial file, see PartialUpload and client.PartialDownload
+class PartialFile:
     filename: str
     size: int # bytes
-    chunks: dict[int, str] # Map chunk no. to bytes
+    chunkSize: int # bytes
+    received: bytearray # Bitmap of chunks written to the partial file
+    noReceived: int # No. of bits set in received
+    finishing: bool # Some worker is writing the upload to disk
+    digest: str | None # Expected digest of the whole file, see fileDigest()
+    hashes: list[str] | None # Expected hash of each chunk, only when the chunks are the ones the digest was computed over
+    legacy: bool # Size and chunks count characters, as with peers that do not negotiate chunk sizes
+    chunks: dict[int, bytes] # Legacy chunks, kept until all are in as their byte offsets are unknown until then
+    fd: int # Partial file, preallocated to size
+    savedAt: float # When the state was last saved next to the partial file
+    lock: RLock # Guards received, noReceived and finishing
 
-    def __init__(self, filename: str, size: int):
+    def __init__(self, filename: str, size: int, chunkSize: int = CHUNK_SIZE, digest: str | None = None, hashes: list[str] | None = None, legacy: bool = False):
         self.filename = filename
         self.size = size
+        self.chunkSize = chunkSize
+        self.digest = digest
+        # A manifest that does not add up to the digest is useless, check the whole file at the end instead
+        usable = digest is not None and hashes is not None and chunkSize == chooseChunkSize(size) and len(hashes) == noOfChunks(size, chunkSize) and rootHash(hashes) == digest
+        self.hashes = hashes if usable else None
+        self.legacy = legacy
         self.chunks = dict()
+        self.received = bytearray(ceil(self.noOfChunks() / 8))
+        self.noReceived = 0
+        self.finishing = False
+        self.fd = -1
+        self.savedAt = 0
+        self.lock = RLock()
+
+    # Create the partial file, or pick up where an earlier transfer of the same content left off.
+    # Kept out of __init__ so that the upload can be registered before the (possibly slow) preallocation
+    def open(self):
+        if self.resume():
+            log(f"Resuming {self.filename} with {self.noReceived} of {self.noOfChunks()} chunks")
+            return
+        self.fd = os.open(partial(self.filename), os.O_RDWR | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o666)
+        if self.legacy: # The size in bytes is only known once every chunk is in
+            return
+        try:
+            if hasattr(os, "posix_fallocate") and self.size > 0:
+                os.posix_fallocate(self.fd, 0, self.size)
+            else:
+                os.ftruncate(self.fd, self.size)
+        except OSError:
+            os.ftruncate(self.fd, self.size) # Filesystem cannot reserve blocks, a sparse file will do
+        self.saveState(force=True) # Advertised to swarming peers before the first chunk arrives
     
+    # Only transfers with a digest are resumed, without one there is no telling whether the content is the same
+    def resume(self) -> bool:
+        if self.digest is None:
+            return False
+        try:
+            with open(partialState(self.filename)) as f:
+                state = json.load(f)
+            if (state["size"], state["chunkSize"], state["digest"]) != (self.size, self.chunkSize, self.digest) or getsize(partial(self.filename)) != self.size:
+                return False
+            received = bytearray.fromhex(state["received"])
+        except (OSError, ValueError, KeyError, TypeError):
+            return False
+        if len(received) != len(self.received):
+            return False
+        self.fd = os.open(partial(self.filename), os.O_RDWR | getattr(os, "O_BINARY", 0))
+        self.received = received
+        self.noReceived = sum(bin(byte).count("1") for byte in received)
+        return True
+
+    # Write the state sidecar, at most every STATE_INTERVAL unless forced
+    def saveState(self, force: bool = False):
+        if self.digest is None or (not force and monotonic() - self.savedAt < STATE_INTERVAL):
+            return
+        with self.lock:
+            self.savedAt = monotonic()
+            state = {"size": self.size, "chunkSize": self.chunkSize, "digest": self.digest, "hashes": self.hashes, "received": self.received.hex()}
+        try:
+            with open(f"{partialState(self.filename)}.tmp", "w") as f:
+                json.dump(state, f)
+            os.replace(f"{partialState(self.filename)}.tmp", partialState(self.filename))
+        except OSError as e:
+            error(f"{e}")
+
+    # Stop receiving for now. The partial file and its state stay for a later resume, if the transfer can be resumed at all
+    def suspend(self):
+        if self.digest is None:
+            return self.discard()
+        self.saveState(force=True)
+        try:
+            os.close(self.fd)
+        except OSError:
+            pass
+
+    # Byte spans (offset, length) not received yet
+    def missing(self) -> list[tuple[int, int]]:
+        spans: list[tuple[int, int]] = []
+        with self.lock:
+            for chunk in range(self.noOfChunks()):
+                if self.has(chunk):
+                    continue
+                offset, length = chunk * self.chunkSize, min(self.chunkSize, self.size - chunk * self.chunkSize)
+                if len(spans) > 0 and spans[-1][0] + spans[-1][1] == offset:
+                    spans[-1] = (spans[-1][0], spans[-1][1] + length)
+                else:
+                    spans.append((offset, length))
+        return spans
+
     def noOfChunks(self) -> int:
-        return ceil(float(self.size) / 100.0)
+        return noOfChunks(self.size, self.chunkSize)
+
+    def has(self, chunk: int) -> bool:
+        return bool(self.received[chunk // 8] & (1 << (chunk % 8)))
 
     def isComplete(self) -> bool:
-        return all([chunk in self.chunks for chunk in range(self.noOfChunks())])
+        return self.noReceived == self.noOfChunks()
+
+    # True for exactly one caller once the upload is complete, who must then call writeToDisk()
+    def finish(self) -> bool:
+        with self.lock:
+            if not self.isComplete() or self.finishing:
+                return False
+            self.finishing = True
+            return True
     
-    def save(self, chunk: int, content: str):
-        self.chunks[chunk] = content
+    def save(self, chunk: int, content: str | bytes) -> bool:
+        if chunk < 0 or chunk >= self.noOfChunks():
+            return error(f"Chunk {chunk} out of range for {self.filename}")
+        if self.legacy:
+            if len(toText(content)) != min(self.chunkSize, self.size - chunk * self.chunkSize):
+                return error(f"Chunk {chunk} of {self.filename} has wrong length {len(toText(content))}")
+            with self.lock:
+                self.chunks[chunk] = toBytes(content)
+                self.mark(chunk, chunk + 1)
+            return True
+        data = toBytes(content)
+        if len(data) != min(self.chunkSize, self.size - chunk * self.chunkSize):
+            return error(f"Chunk {chunk} of {self.filename} has wrong length {len(data)}")
+        self.write(chunk * self.chunkSize, data)
+        return True
+
+    # Save a byte range spanning whole chunks, e.g. the content of a DOWNLOAD range response
+    def saveRange(self, offset: int, content: str | bytes) -> bool:
+        data = toBytes(content)
+        end = offset + len(data)
+        if offset < 0 or offset % self.chunkSize != 0 or len(data) == 0 or end > self.size or (end % self.chunkSize != 0 and end != self.size):
+            return error(f"Range {offset} {len(data)} of {self.filename} does not span whole chunks")
+        self.write(offset, data)
+        return True
+
+    # Chunks in data, which starts at offset, that do not match the manifest
+    def corrupt(self, offset: int, content: str | bytes) -> list[int]:
+        if self.hashes is None:
+            return []
+        data = memoryview(toBytes(content))
+        first = offset // self.chunkSize
+        return [chunk for chunk in range(first, noOfChunks(offset + len(data), self.chunkSize))
+                if chunk >= len(self.hashes) or chunkHash(data[(chunk - first) * self.chunkSize:(chunk - first + 1) * self.chunkSize]) != self.hashes[chunk]]
+
+    # Whether the complete partial file matches the digest. Chunks checked against the manifest on arrival need no second look
+    def verify(self) -> bool:
+        if self.digest is None or self.hashes is not None:
+            return True
+        try:
+            os.fsync(self.fd)
+            digest, hashes = fileDigest(partial(self.filename))
+        except OSError as e:
+            return error(f"{e}")
+        if digest != self.digest:
+            return error(f"{self.filename} does not match digest {self.digest}")
+        self.hashes = hashes
+        return True
+
+    def write(self, offset: int, data: bytes | bytearray):
+        if hasattr(os, "pwrite"):
+            os.pwrite(self.fd, data, offset)
+        else:
+            with self.lock: # No positional writes on this platform, serialise seek + write instead
+                os.lseek(self.fd, offset, os.SEEK_SET)
+                os.write(self.fd, data)
+        with self.lock:
+            self.mark(offset // self.chunkSize, noOfChunks(offset + len(data), self.chunkSize))
+        self.saveState()
+
+    # Record chunks first up to end as received, under the lock
+    def mark(self, first: int, end: int):
+        for chunk in range(first, end):
+            if not self.has(chunk):
+                self.received[chunk // 8] |= 1 << (chunk % 8)
+                self.noReceived += 1
     
     def writeToDisk(self):
         if not self.isComplete():
-            return error(f"Upload for {self.filename} is not complete")
+            return error(f"Transfer of {self.filename} is not complete")
         if exists(served(self.filename)):
+            self.discard()
             return error(f"{served(self.filename)} already exists")
-        log(f"Writing chunks:\n{self.chunks}")
         try:
-            with open(served(self.filename), 'x') as f:
-                combined = reintegrate([self.chunks[chunk] for chunk in range(self.noOfChunks())])
-                noChars = f.write(combined)
-                assert noChars == len(combined)
-        except Exception as e:
-            error(f"{e}")
+            if self.legacy:
+                os.write(self.fd, b"".join(self.chunks[chunk] for chunk in range(self.noOfChunks())))
+            os.fsync(self.fd)
+            os.close(self.fd)
+            # Readers only ever see the complete file
+            os.replace(partial(self.filename), served(self.filename))
+        except OSError as e:
+            return error(f"{e}")
+        self.removeState()
+        blockCache.discard(self.filename)
+        fileIndex.add(self.filename, self.digest, self.hashes)
+
+    # Complete the transfer from an identical served file, without receiving anything
+    def adopt(self, source: str) -> bool:
+        try:
+            try:
+                os.link(served(source), partial(self.filename)) # Served files are only ever replaced, never written in place, so sharing the inode is safe
+            except OSError:
+                shutil.copyfile(served(source), partial(self.filename))
+            os.replace(partial(self.filename), served(self.filename))
+        except OSError as e:
+            return error(f"{e}")
+        self.removeState()
+        blockCache.discard(self.filename)
+        fileIndex.add(self.filename, *(fileIndex.indexed(source) or (None, None)))
+        return True
+
+    # Abandon the transfer and remove the partial file
+    def discard(self):
+        try:
+            os.close(self.fd)
+        except OSError:
+            pass
+        try:
+            os.remove(partial(self.filename))
+        except OSError:
+            pass
+        self.removeState()
+
+    def removeState(self):
+        try:
+            os.remove(partialState(self.filename))
+        except OSError:
+            pass
+
+class PartialUpload(PartialFile):
+    replica: "Replica | None" = None # Next peer of a replication chain, which the chunks are passed on to
+    claimFd: int = -1 # Lock file held while receiving
+
+    # Lock the upload against the other worker processes of this server, which share served_files/ but not
+    # Server.uploads. The lock goes away with the process, so a crashed worker leaves nothing to clean up
+    def claim(self) -> bool:
+        if fcntl is None:
+            return True
+        while True:
+            try:
+                fd = os.open(partialClaim(self.filename), os.O_RDWR | os.O_CREAT, 0o666)
+            except OSError as e:
+                return error(f"{e}")
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(fd)
+                return False
+            try:
+                if os.fstat(fd).st_ino == os.stat(partialClaim(self.filename)).st_ino:
+                    self.claimFd = fd
+                    return True
+            except OSError:
+                pass
+            os.close(fd) # Locked a claim file that its holder removed on release meanwhile, try a fresh one
+
+    def release(self):
+        if self.claimFd < 0:
+            return
+        try:
+            os.remove(partialClaim(self.filename)) # Still locked, so nobody holds a lock on it after this
+        except OSError:
+            pass
+        os.close(self.claimFd)
+        self.claimFd = -1
 
 class CommandType(Enum):
     FILELIST = 0
     UPLOAD = 1
     DOWNLOAD = 2
     DELETE = 3
+    PROTOCOL = 4
+    STATS = 5
 
     def toString(self) -> str:
         match self:
@@ -112,6 +971,10 @@ class CommandType(Enum):
                 return "#DOWNLOAD"
             case CommandType.DELETE:
                 return "#DELETE"
+            case CommandType.PROTOCOL:
+                return "#PROTOCOL"
+            case CommandType.STATS:
+                return "#STATS"
             case _:
                 raise "Invalid command type"
     
@@ -123,21 +986,34 @@ class UserCommand:
     type: CommandType
     ids: list[str]
     filename: str | None = None  # Used in upload/ download only
+    pattern: str | None = None # FILELIST only, glob the listed file names must match
+    offset: int | None = None # FILELIST only, no. of matching files to skip
+    limit: int | None = None # FILELIST only, most files to list
+    replicate: list[str] | None = None # UPLOAD only, peers the receiving peers pass the file on to, in chain order
+    stripe: tuple[int, int] | None = None # UPLOAD only, no. of data and parity shards to spread the file across
+    striped: bool = False # DOWNLOAD only, rebuild the file from its shards
 
-    def __init__(self, type: CommandType, ids: list[str], filename: str | None = None):
+    def __init__(self, type: CommandType, ids: list[str], filename: str | None = None, pattern: str | None = None, offset: int | None = None, limit: int | None = None, replicate: list[str] | None = None, stripe: tuple[int, int] | None = None, striped: bool = False):
         self.type = type
         self.ids = ids
         match self.type:
             case CommandType.FILELIST:
+                self.pattern = pattern
+                self.offset = offset
+                self.limit = limit
+            case CommandType.STATS:
                 pass
             case CommandType.UPLOAD:
                 if filename == None:
                     raise "Server error: upload command does not have filename"
                 self.filename = filename
+                self.replicate = replicate
+                self.stripe = stripe
             case CommandType.DOWNLOAD:
                 if filename == None:
                     raise "Server error: download command does not have filename"
                 self.filename = filename
+                self.striped = striped
             case CommandType.DELETE:
                 if filename == None:
                     raise "Server error: delete command does not have filename"
@@ -150,21 +1026,46 @@ class UserCommand:
         if len(components) < 1:
             return error("No command")
         match components[0]:
-            case "#FILELIST":
+            case "#FILELIST": # #FILELIST <ids> [match <glob>] [offset <n>] [limit <n>]
                 ids = components[1:]
-                return UserCommand(CommandType.FILELIST, ids)
-            case "#UPLOAD":
+                options = dict()
+                for i, component in enumerate(ids):
+                    if component in ("match", "offset", "limit"):
+                        ids, options = ids[:i], parseOptions(" ".join(ids[i:]), ("match",))
+                        break
+                if options is None:
+                    return error("Invalid file list options")
+                return UserCommand(CommandType.FILELIST, ids, pattern=options.get("match"), offset=options.get("offset"), limit=options.get("limit"))
+            case "#UPLOAD": # #UPLOAD <filename> <ids> [replicate <id>,<id>...] [stripe <k>+<m>]
                 filename = components[1]
                 ids = components[2:]
-                return UserCommand(CommandType.UPLOAD, ids, filename)
-            case "#DOWNLOAD":
+                options = dict()
+                for i, component in enumerate(ids):
+                    if component in ("replicate", "stripe"):
+                        ids, options = ids[:i], parseOptions(" ".join(ids[i:]), ("replicate", "stripe"))
+                        break
+                if options is None or not set(options.keys()) <= {"replicate", "stripe"}:
+                    return error("Invalid upload options")
+                stripe = None
+                if "stripe" in options:
+                    try:
+                        k, m = options["stripe"].split("+")
+                        stripe = (int(k), int(m))
+                    except ValueError:
+                        return error(f"Invalid stripe {options["stripe"]}, expected <data shards>+<parity shards>")
+                return UserCommand(CommandType.UPLOAD, ids, filename, replicate=options["replicate"].split(",") if "replicate" in options else None, stripe=stripe)
+            case "#DOWNLOAD": # #DOWNLOAD <filename> <ids> [stripe]
                 filename = components[1]
                 ids = components[2:]
-                return UserCommand(CommandType.DOWNLOAD, ids, filename)
+                striped = len(ids) > 0 and ids[-1] == "stripe"
+                return UserCommand(CommandType.DOWNLOAD, ids[:-1] if striped else ids, filename, striped=striped)
             case "#DELETE":
                 filename = components[1]
                 ids = components[2:]
                 return UserCommand(CommandType.DELETE, ids, filename)
+            case "#STATS":
+                ids = components[1:]
+                return UserCommand(CommandType.STATS, ids)
             case _:
                 return error("Server error: invalid command type in UserCommand.fromString(...)")
             
@@ -172,33 +1073,53 @@ class UserCommand:
         return UserCommand.fromString(unquote(command))
     
     def toString(self) -> str:
-        return f"UserCommand(type={self.type.toString()}, ids={self.ids}{f", {self.filename}" if self.filename is not None else ""})"
+        return f"UserCommand(type={self.type.toString()}, ids={self.ids}{f", {self.filename}" if self.filename is not None else ""}{f", match {self.pattern}" if self.pattern is not None else ""}{f", offset {self.offset}" if self.offset is not None else ""}{f", limit {self.limit}" if self.limit is not None else ""}{f", replicate {",".join(self.replicate)}" if self.replicate is not None else ""}{f", stripe {self.stripe[0]}+{self.stripe[1]}" if self.stripe is not None else ""}{", striped" if self.striped else ""})"
 
 class Command:
     type: CommandType
     filename: str | None = None
     bytes: int | None = None
     chunk: int | None = None
-    content: str | None = None
+    chunkSize: int | None = None # Negotiated in UPLOAD/DOWNLOAD intents, repeated in DOWNLOAD chunk requests
+    offset: int | None = None # DOWNLOAD range requests, and the no. of files FILELIST skips
+    length: int | None = None # DOWNLOAD range requests only
+    pattern: str | None = None # FILELIST only, see UserCommand
+    limit: int | None = None # FILELIST only, see UserCommand
+    codec: Codec | None = None # Compression asked for in UPLOAD/DOWNLOAD intents and DOWNLOAD requests, or applied to UPLOAD chunks
+    digest: str | None = None # UPLOAD intents only, see fileDigest()
+    hashes: list[str] | None = None # UPLOAD intents only, the chunk hashes behind digest
+    replicate: list[str] | None = None # UPLOAD intents only, see UserCommand
+    content: str | bytes | None = None # str over the text protocol, raw bytes over protocol v2
 
-    def __init__(self, type: CommandType, filename: str | None = None, bytes: int | None = None, chunk: int | None = None, content: str | None = None):
+    def __init__(self, type: CommandType, filename: str | None = None, bytes: int | None = None, chunk: int | None = None, content: str | bytes | None = None, chunkSize: int | None = None, offset: int | None = None, length: int | None = None, digest: str | None = None, hashes: list[str] | None = None, pattern: str | None = None, limit: int | None = None, codec: Codec | None = None, replicate: list[str] | None = None):
         self.type = type
         self.filename = filename
         self.bytes = bytes
         self.chunk = chunk
+        self.chunkSize = chunkSize
+        self.offset = offset
+        self.length = length
+        self.digest = digest
+        self.hashes = hashes
+        self.pattern = pattern
+        self.limit = limit
+        self.codec = codec
+        self.replicate = replicate
         self.content = content
 
     def __eq__(self, other: "Command") -> bool:
-        return self.type == other.type and self.filename == other.filename and self.bytes == other.bytes and self.chunk == other.chunk and self.content == other.content
+        return self.type == other.type and self.filename == other.filename and self.bytes == other.bytes and self.chunk == other.chunk and self.chunkSize == other.chunkSize and self.offset == other.offset and self.length == other.length and self.digest == other.digest and self.hashes == other.hashes and self.pattern == other.pattern and self.limit == other.limit and self.replicate == other.replicate and self.content == other.content
 
     def toString(self) -> str:
-        return f"{self.type.toString()}{f" {self.filename}" if self.filename is not None else ""}{f" bytes {self.bytes}" if self.bytes != None else ""}{f" chunk {self.chunk}" if self.chunk != None else ""}{f" {self.content}" if self.content != None else ""}"
+        return f"{self.toDisplayString()}{f" manifest {",".join(self.hashes)}" if self.hashes else ""}{f" {toText(self.content)}" if self.content != None else ""}"
     
     def toDisplayString(self) -> str:
-        return f"{self.type.toString()}{f" {self.filename}" if self.filename is not None else ""}{f" bytes {self.bytes}" if self.bytes != None else ""}{f" chunk {self.chunk}" if self.chunk != None else ""}"
+        if self.type == CommandType.FILELIST:
+            return f"{self.type.toString()}{f" match {self.pattern}" if self.pattern is not None else ""}{f" offset {self.offset}" if self.offset is not None else ""}{f" limit {self.limit}" if self.limit is not None else ""}"
+        return f"{self.type.toString()}{f" {self.filename}" if self.filename is not None else ""}{f" bytes {self.bytes}" if self.bytes != None else ""}{f" chunk {self.chunk}" if self.chunk != None else ""}{f" range {self.offset} {self.length}" if self.offset != None else ""}{f" chunksize {self.chunkSize}" if self.chunkSize != None else ""}{f" digest {self.digest}" if self.digest != None else ""}{f" compress {self.codec.toString()}" if self.codec is not None and self.content is None else ""}{f" replicate {",".join(self.replicate)}" if self.replicate else ""}"
     
     def toSafeString(self) -> str:
-        return quote(self.toString()) + "\n"
+        return quote(self.toString(), errors="surrogateescape") + "\n"
 
     def fromString(command: str) -> "Command":
         if len(command) == 0:
@@ -210,13 +1131,18 @@ class Command:
             type = command
         match type:
             case "#FILELIST":
-                return Command(type=CommandType.FILELIST)
+                options = parseOptions(command if command != type else "", ("match",))
+                if options is None:
+                    return error("Invalid command")
+                return Command(type=CommandType.FILELIST, pattern=options.get("match"), offset=options.get("offset"), limit=options.get("limit"))
             case "#UPLOAD":
                 filename, command = command.split(" ", 1)
                 bytesOrChunk, command = command.split(" ", 1)
                 if bytesOrChunk == "bytes":
-                    bytes = int(command)
-                    return Command(type=CommandType.UPLOAD, filename=filename, bytes=bytes)
+                    options = parseOptions(f"bytes {command}", ("digest", "manifest", "compress", "replicate"))
+                    if options is None or "bytes" not in options:
+                        return error("Invalid command")
+                    return Command(type=CommandType.UPLOAD, filename=filename, bytes=options["bytes"], chunkSize=options.get("chunksize"), digest=options.get("digest"), hashes=options["manifest"].split(",") if "manifest" in options else None, codec=Codec.fromString(options.get("compress")), replicate=options["replicate"].split(",") if "replicate" in options else None)
                 elif bytesOrChunk == "chunk":
                     chunk, content = command.split(" ", 1)
                     chunk = int(chunk)
@@ -224,27 +1150,59 @@ class Command:
                 else:
                     return error("Invalid command")
             case "#DOWNLOAD":
-                filenameAndOptionalChunk = command.split(" ", 1)
-                if len(filenameAndOptionalChunk) == 1:
-                    filename = filenameAndOptionalChunk[0]
-                    return Command(type=CommandType.DOWNLOAD, filename=filename)
-                else:
-                    filename = filenameAndOptionalChunk[0]
-                    _, chunk = filenameAndOptionalChunk[1].split(" ", 1)
-                    log("Command.fromString() point 5")
-                    chunk = int(chunk)
-                    log("Command.fromString() point 6")
-                    return Command(type=CommandType.DOWNLOAD, filename=filename, chunk=chunk)
+                filenameAndOptions = command.split(" ", 1)
+                filename = filenameAndOptions[0]
+                options = filenameAndOptions[1] if len(filenameAndOptions) == 2 else ""
+                offset, length = None, None
+                if options.startswith("range "): # range <offset> <length>, then any other options
+                    rangeAndOptions = options.split(" ", 3)
+                    try:
+                        offset, length = int(rangeAndOptions[1]), int(rangeAndOptions[2])
+                    except (ValueError, IndexError):
+                        return error("Invalid command")
+                    options = rangeAndOptions[3] if len(rangeAndOptions) == 4 else ""
+                options = parseOptions(options, ("compress",))
+                if options is None:
+                    return error("Invalid command")
+                return Command(type=CommandType.DOWNLOAD, filename=filename, chunk=options.get("chunk"), chunkSize=options.get("chunksize"), offset=offset, length=length, codec=Codec.fromString(options.get("compress")))
             case "#DELETE":
                 filename = command
                 return Command(type=CommandType.DELETE, filename=filename)
+            case "#PROTOCOL":
+                return Command(type=CommandType.PROTOCOL, content=command if command != type else None)
+            case "#STATS":
+                return Command(type=CommandType.STATS)
             case _:
                 return error(f"Invalid command type {type}")
             
     def fromSafeString(command: str) -> "Command":
         if command.endswith("\n"):
             command = command.splitlines()[0] # Remove newline
-        return Command.fromString(unquote(command))
+        return Command.fromString(unquote(command, errors="surrogateescape"))
+
+    def toWire(self, binary: bool) -> bytes:
+        return self.toFrame().toBytes() if binary else self.toSafeString().encode()
+
+    def fromReceived(received: "str | Frame") -> "Command | None":
+        return Command.fromSafeString(received) if isinstance(received, str) else Command.fromFrame(received)
+
+    def toFrame(self) -> "Frame":
+        if self.chunk is not None and self.content is not None:
+            payload, compression = self.codec.compress(toBytes(self.content)) if self.codec is not None else (toBytes(self.content), 0)
+            return Frame(self.type.value, FLAG_CHUNK | compression, self.filename, self.chunk, payload)
+        return Frame(self.type.value, payload=toBytes(self.toString()))
+
+    def fromFrame(frame: "Frame") -> "Command":
+        if frame.flags & FLAG_CHUNK:
+            try:
+                type = CommandType(frame.opcode)
+            except ValueError:
+                return error(f"Invalid opcode {frame.opcode}")
+            content = decompress(frame.payload, frame.flags, MAX_CHUNK_SIZE)
+            if content is None:
+                return None
+            return Command(type=type, filename=frame.filename, chunk=frame.offset, content=content)
+        return Command.fromString(toText(frame.payload))
 
 
 class ResponseCode(Enum):
@@ -273,26 +1231,99 @@ class ResponseCode(Enum):
             case _:
                 return False
 
+    def toOpcode(self) -> int:
+        match self:
+            case ResponseCode.k200:
+                return 0x80
+            case ResponseCode.k250:
+                return 0x81
+            case ResponseCode.k330:
+                return 0x82
+
+    def fromOpcode(opcode: int) -> "ResponseCode | None":
+        match opcode:
+            case 0x80:
+                return ResponseCode.k200
+            case 0x81:
+                return ResponseCode.k250
+            case 0x82:
+                return ResponseCode.k330
+            case _:
+                return error(f"Invalid response opcode {opcode}")
+
 
 class Response:
     code: ResponseCode
     content: str
+    filename: str | None = None # Chunk responses only
+    chunk: int | None = None # Chunk responses only
+    offset: int | None = None # Range responses only
+    data: str | bytes | None = None # Chunk content, sent after content
+    fileRange: tuple[str, int, int] | None = None # (path, offset, length) of chunk content not yet read from disk
+    codec: Codec | None = None # Compression the client asked for, protocol v2 only
+    compression: int = 0 # FLAG_ZLIB/ FLAG_LZMA once data is compressed
 
-    def __init__(self, code: ResponseCode = ResponseCode(200), content: str = ""):
+    def __init__(self, code: ResponseCode = ResponseCode(200), content: str = "", filename: str | None = None, chunk: int | None = None, data: str | bytes | None = None, fileRange: tuple[str, int, int] | None = None, offset: int | None = None, codec: Codec | None = None):
         self.code = code
         self.content = content
+        self.filename = filename
+        self.chunk = chunk
+        self.offset = offset
+        self.data = data
+        self.fileRange = fileRange
+        self.codec = codec
+
+    # Read the chunk content from disk, for connections that cannot send it straight from the file
+    def load(self):
+        if self.data is None and self.fileRange is not None:
+            self.data = chunkReader.read(*self.fileRange)
+
+    # Read and compress the chunk content, unless a sample shows it is not worth it and it can stay on disk for sendfile
+    def compress(self):
+        if self.codec is None or (self.data is None and self.fileRange is None):
+            return
+        if self.data is None:
+            path, offset, length = self.fileRange
+            if not self.codec.worthwhile(chunkReader.read(path, offset, min(length, COMPRESSION_SAMPLE))):
+                self.codec = None
+                return
+            self.load()
+        self.data, self.compression = self.codec.compress(toBytes(self.data))
+        self.codec = None
 
     def toString(self) -> str:
-        return f"{self.code.value} {self.content}"
+        return f"{self.code.value} {self.content}{f" {toText(self.data)}" if self.data is not None else ""}"
     
     def toDisplayString(self) -> str:
-        if "chunk " in self.content and not "received" in self.content:
+        if self.data is not None or self.fileRange is not None:
+            return f"{self.code.value} {self.content}"
+        if self.code.ok() and "chunk " in self.content and not "received" in self.content:
             content = " ".join(self.content.split(" ", 4)[:4])
             return f"{self.code.value} {content}"
+        if " manifest " in self.content: # Leave out the chunk hashes
+            return f"{self.code.value} {self.content.split(" manifest ", 1)[0]}"
+        if " range " in self.content: # Text protocol range response, leave out the content
+            content = " ".join(self.content.split(" ", 5)[:5])
+            return f"{self.code.value} {content}"
         return self.toString()
     
     def toSafeString(self) -> str:
-        return quote(self.toString()) + "\n"
+        return quote(self.toString(), errors="surrogateescape") + "\n"
+
+    # Look up the number following key in the content, e.g. value("bytes") in "Ready to send file f bytes 10"
+    def value(self, key: str) -> int | None:
+        try:
+            return int(self.option(key))
+        except (TypeError, ValueError):
+            return None
+
+    # Look up the word following key in the content, e.g. option("digest")
+    def option(self, key: str) -> str | None:
+        components = self.content.split()
+        for i, component in enumerate(components[:-1]):
+            if component == key:
+                return components[i + 1]
+        return None
 
     def fromString(response: str) -> "Response":
         components = response.split(" ", 1)
@@ -300,94 +1331,609 @@ class Response:
     
     def fromSafeString(response: str) -> "Response":
         response = response.splitlines()[0] # Remove newline
-        return Response.fromString(unquote(response))
+        return Response.fromString(unquote(response, errors="surrogateescape"))
 
+    def toWire(self, binary: bool) -> bytes:
+        return self.toFrame().toBytes() if binary else self.toSafeString().encode()
 
-class ServerWorker(Thread):
-    client: tuple[socket, object]
-    uploads: dict[str, PartialUpload]  # Map filename to command
-    workerUploads: set[str] # Set of uploads handled by this worker
-    connectionSocket: socket
-    serverId: int
+    def toFrame(self) -> "Frame":
+        flags, offset = (FLAG_RANGE, self.offset) if self.offset is not None else (FLAG_CHUNK, self.chunk)
+        if self.fileRange is not None and self.data is None: # Payload follows via sendFileRange()
+            return Frame(self.code.toOpcode(), flags, self.filename, offset)
+        if self.data is not None:
+            return Frame(self.code.toOpcode(), flags | self.compression, self.filename, offset, toBytes(self.data))
+        return Frame(self.code.toOpcode(), payload=toBytes(self.content))
 
-    def __init__(self, client: tuple[socket, object], uploads: dict[str, PartialUpload], serverId: int, group=None, target=None, name=None, args=..., kwargs=None, *, daemon=None):
-        super().__init__(group, target, name, args, kwargs, daemon=daemon)
-        log("New ServerWorker")
-        self.client = client
-        self.connectionSocket, addr = self.client
-        self.connectionSocket.settimeout(0.5)
-        self.uploads = uploads
-        self.serverId = serverId
-        self.workerUploads = set()
+    def fromFrame(frame: "Frame") -> "Response | None":
+        code = ResponseCode.fromOpcode(frame.opcode)
+        if code is None:
+            return None
+        data = decompress(frame.payload, frame.flags)
+        if data is None:
+            return None
+        if frame.flags & FLAG_CHUNK:
+            return Response(code=code, content=f"File {frame.filename} chunk {frame.offset}", filename=frame.filename, chunk=frame.offset, data=data)
+        if frame.flags & FLAG_RANGE:
+            return Response(code=code, content=f"File {frame.filename} range {frame.offset} {len(data)}", filename=frame.filename, offset=frame.offset, data=data)
+        return Response(code=code, content=toText(frame.payload))
 
-    def receive(self) -> str | None:
-        s = ""
-        start = time_ns()
-        while not s.endswith("\n"):
-            now = time_ns()
-            if now - start > 1E9:
-                return error("Timeout while receiving")
+
+class Frame:
+    opcode: int
+    flags: int
+    filename: str
+    offset: int
+    payload: bytes
+
+    def __init__(self, opcode: int, flags: int = 0, filename: str | None = None, offset: int | None = None, payload: bytes = b""):
+        self.opcode = opcode
+        self.flags = flags
+        self.filename = filename if filename is not None else ""
+        self.offset = offset if offset is not None else 0
+        self.payload = payload
+
+    # Header and filename, for a payload of payloadLength bytes that is sent separately
+    def header(self, payloadLength: int) -> bytes:
+        filename = self.filename.encode()
+        return FRAME.pack(self.opcode, self.flags, len(filename), self.offset, payloadLength) + filename
+
+    def toBytes(self) -> bytes:
+        return self.header(len(self.payload)) + self.payload
+
+
+class Connection:
+    socket: socket
+    buffer: bytearray # Received but not yet consumed
+    binary: bool # Protocol v2 framing negotiated
+
+    def __init__(self, socket: socket):
+        self.socket = socket
+        self.buffer = bytearray()
+        self.binary = False
+
+    def fill(self) -> bool:
+        try:
+            buffer = self.socket.recv(65536)
+        except TimeoutError:
+            stats.timeout()
+            return error("Timeout while receiving")
+        except OSError as e:
+            return error(f"Could not receive: {e}")
+        if len(buffer) == 0:
+            return error("Connection closed")
+        self.buffer += buffer
+        stats.transferred(bytesIn=len(buffer))
+        return True
+
+    def receiveExactly(self, length: int) -> bytes | None:
+        while len(self.buffer) < length:
+            if not self.fill():
+                return None
+        received = bytes(self.buffer[:length])
+        del self.buffer[:length]
+        return received
+
+    def receiveLine(self) -> str | None:
+        end = self.buffer.find(b"\n")
+        while end < 0:
+            if len(self.buffer) > MAX_LINE_SIZE:
+                return error("Line too long")
+            searched = len(self.buffer)
+            if not self.fill():
+                return None
+            end = self.buffer.find(b"\n", searched)
+        line = self.buffer[:end + 1]
+        del self.buffer[:end + 1]
+        try:
+            return line.decode()
+        except UnicodeDecodeError:
+            return error("Invalid line") # Lines are quoted, so this is no peer of ours
+
+    def receiveFrame(self) -> Frame | None:
+        header = self.receiveExactly(FRAME.size)
+        if header is None:
+            return None
+        opcode, flags, filenameLength, offset, payloadLength = FRAME.unpack(header)
+        if payloadLength > MAX_FRAME_SIZE:
+            return error(f"Frame payload of {payloadLength} bytes too long")
+        filename = self.receiveExactly(filenameLength)
+        payload = self.receiveInto(payloadLength)
+        if filename is None or payload is None:
+            return None
+        try:
+            return Frame(opcode, flags, filename.decode(), offset, payload)
+        except UnicodeDecodeError:
+            return error("Invalid file name in frame")
+
+    # Receive a payload straight into a preallocated buffer instead of growing and slicing self.buffer
+    def receiveInto(self, length: int) -> bytearray | None:
+        payload = bytearray(length)
+        view = memoryview(payload)
+        received = min(len(self.buffer), length)
+        view[:received] = self.buffer[:received]
+        del self.buffer[:received]
+        buffered = received # Already counted by fill()
+        while received < length:
             try:
-                s = self.connectionSocket.recv(1024).decode()
+                noBytes = self.socket.recv_into(view[received:])
             except TimeoutError:
+                stats.timeout()
                 return error("Timeout while receiving")
-            sleep(0.01)
-        return s
-    
-    def send(self, response: str):
+            except OSError as e:
+                return error(f"Could not receive: {e}")
+            if noBytes == 0:
+                return error("Connection closed")
+            received += noBytes
+        stats.transferred(bytesIn=received - buffered)
+        return payload
+
+    def receive(self) -> str | Frame | None:
+        return self.receiveFrame() if self.binary else self.receiveLine()
+
+    def receiveResponse(self) -> Response | None:
+        received = self.receive()
+        if received is None:
+            return None
+        return Response.fromFrame(received) if self.binary else Response.fromSafeString(received)
+
+    def send(self, message: Command | Response) -> bool:
         try:
-            self.connectionSocket.send(response.encode())
+            if isinstance(message, Response) and self.binary:
+                message.compress()
+            if isinstance(message, Response) and message.fileRange is not None and message.data is None:
+                if self.binary and hasattr(os, "sendfile"):
+                    return self.sendFileRange(message)
+                message.load()
+            wire = message.toWire(self.binary)
+            self.socket.sendall(wire)
+            stats.transferred(bytesOut=len(wire))
         except TimeoutError:
+            stats.timeout()
             return error("Timeout while sending")
+        except OSError as e:
+            return error(f"Could not send: {e}")
+        return True
+
+    # Send the frame header, then let the kernel copy the payload from the file to the socket
+    def sendFileRange(self, response: Response) -> bool:
+        path, offset, length = response.fileRange
+        header = response.toFrame().header(length)
+        if length == 0:
+            self.socket.sendall(header)
+            return True
+        with chunkReader.open(path) as file: # Opened before the header goes out, a partial file may be renamed meanwhile
+            self.socket.sendall(header)
+            sent = self.socket.sendfile(FileStream(file), offset, length)
+        stats.transferred(bytesOut=len(header) + sent)
+        if sent != length: # File shrank underneath us, the frame is broken
+            return error(f"Sent {sent} of {length} bytes of {path}")
+        return True
+
+    def negotiate(self) -> bool:
+        # Old peers reject #PROTOCOL and drop the connection, so the caller must reconnect on failure
+        if not self.send(Command(CommandType.PROTOCOL, content=str(PROTOCOL_VERSION))):
+            return False
+        response = self.receiveResponse()
+        if response is None or not response.code.ok():
+            return False
+        self.binary = True
+        return True
+
+    # Idle connections have nothing to read, so a readable one was closed by the peer (or is out of sync)
+    def isAlive(self) -> bool:
+        if len(self.buffer) > 0:
+            return False
+        try:
+            readable, _, _ = select([self.socket], [], [], 0)
+        except (OSError, ValueError): # Already closed
+            return False
+        return len(readable) == 0
+
+    def close(self):
+        self.socket.close()
+
+
+# Counters and latency histograms of what the server is doing, reported by #STATS. Every update is a few
+# integer operations under an uncontended lock, so it stays on under load
+class Stats:
+    started: float
+    commands: dict[CommandType, list[int]] # Map command type to [count, errors, total µs, max µs, *histogram]
+    bytesIn: int
+    bytesOut: int
+    workers: int # Connections being served
+    connections: int # Connections served so far
+    timeouts: int
+    lockWaits: int # Acquisitions of uploadsLock
+    lockWaitTime: float # s spent waiting for uploadsLock
+    lockMaxWait: float
+    process: int | None # No. of the worker process these count for, if the server forks
+    lock: Lock
+
+    def __init__(self):
+        self.started = monotonic()
+        self.commands = {type: [0] * (4 + HISTOGRAM_BUCKETS) for type in CommandType}
+        self.bytesIn = 0
+        self.bytesOut = 0
+        self.workers = 0
+        self.connections = 0
+        self.timeouts = 0
+        self.lockWaits = 0
+        self.lockWaitTime = 0
+        self.lockMaxWait = 0
+        self.process = None
+        self.lock = Lock()
+
+    def command(self, type: CommandType, seconds: float, failed: bool):
+        micros = int(seconds * 1e6)
+        with self.lock:
+            counters = self.commands[type]
+            counters[0] += 1
+            counters[1] += failed
+            counters[2] += micros
+            counters[3] = max(counters[3], micros)
+            counters[4 + min(micros.bit_length(), HISTOGRAM_BUCKETS - 1)] += 1
+
+    def transferred(self, bytesIn: int = 0, bytesOut: int = 0):
+        with self.lock:
+            self.bytesIn += bytesIn
+            self.bytesOut += bytesOut
+
+    def timeout(self):
+        with self.lock:
+            self.timeouts += 1
+
+    def connected(self):
+        with self.lock:
+            self.workers += 1
+            self.connections += 1
+
+    def disconnected(self):
+        with self.lock:
+            self.workers -= 1
+
+    # Acquire lock, recording how long that took
+    @contextmanager
+    def locked(self, lock: RLock):
+        start = perf_counter()
+        with lock:
+            wait = perf_counter() - start
+            with self.lock:
+                self.lockWaits += 1
+                self.lockWaitTime += wait
+                self.lockMaxWait = max(self.lockMaxWait, wait)
+            yield
+
+    def snapshot(self, uploads: dict[str, "PartialUpload"]) -> dict:
+        # Upper bound of the bucket holding the percentile, ms
+        def percentile(counters: list[int], p: float) -> float:
+            seen = 0
+            for bucket, noInBucket in enumerate(counters[4:]):
+                seen += noInBucket
+                if seen >= counters[0] * p:
+                    return min(1 << bucket, counters[3]) / 1000
+            return counters[3] / 1000
+
+        with uploadsLock:
+            inFlight = list(uploads.values())
+        with self.lock:
+            commands = {type.name: {
+                "count": counters[0],
+                "errors": counters[1],
+                "meanMs": round(counters[2] / counters[0] / 1000, 3),
+                "p50Ms": percentile(counters, 0.5),
+                "p99Ms": percentile(counters, 0.99),
+                "maxMs": counters[3] / 1000
+            } for type, counters in self.commands.items() if counters[0] > 0}
+            return {
+                "uptime": round(monotonic() - self.started, 3),
+                **({"process": self.process, "pid": os.getpid()} if self.process is not None else {}),
+                "workers": self.workers,
+                "connections": self.connections,
+                "timeouts": self.timeouts,
+                "bytesIn": self.bytesIn,
+                "bytesOut": self.bytesOut,
+                "commands": commands,
+                "cache": blockCache.snapshot(),
+                "uploadsLock": {"acquisitions": self.lockWaits, "waitMs": round(self.lockWaitTime * 1000, 3), "maxWaitMs": round(self.lockMaxWait * 1000, 3)},
+                "uploads": {upload.filename: {"bytes": upload.size, "chunks": upload.noOfChunks(), "received": upload.noReceived} for upload in inFlight}
+            }
+
+    # Write a snapshot to filepath every STATS_INTERVAL
+    def dump(self, filepath: str, uploads: dict[str, "PartialUpload"]):
+        while True:
+            sleep(STATS_INTERVAL)
+            try:
+                with open(f"{filepath}.tmp", "w") as f:
+                    json.dump(self.snapshot(uploads), f, indent=2)
+                os.replace(f"{filepath}.tmp", filepath)
+            except OSError as e:
+                error(f"Could not write stats: {e}")
+
+stats = Stats()
+
+
+# The next peer of a replication chain, which an upload is passed on to chunk by chunk as it arrives, so that the
+# client sends each byte once. The intent carries the rest of the chain, which that peer passes the file on to in
+# turn. Chunks are sent without waiting for their responses; a thread collects those.
+class Replica:
+    filename: str
+    chain: list[str] # Peers to replicate to, the first being the one connected to
+    chunkSize: int
+    connection: Connection | None
+    held: bytes # Bitmap of chunks the peer kept from an earlier attempt
+    sent: int # No. of chunks passed on
+    answered: int # No. of responses to them
+    final: Response | None # Response to the chunk that completed the file, or to the intent if the peer already had it
+    broken: bool # The connection failed
+    failed: list[str] # Peers that could not be replicated to
+    lock: Lock # Serialises sending
+    condition: Condition # Guards sent, answered, final and broken
+
+    def __init__(self, filename: str, chain: list[str], chunkSize: int):
+        self.filename = filename
+        self.chain = chain
+        self.chunkSize = chunkSize
+        self.connection = None
+        self.held = b""
+        self.sent = 0
+        self.answered = 0
+        self.final = None
+        self.broken = False
+        self.failed = []
+        self.lock = Lock()
+        self.condition = Condition()
+
+    def connect(self, id: str, settings: dict[str, tuple[str, int]]) -> Connection | None:
+        if id not in settings:
+            return error(f"Unknown peer {id}")
+        try:
+            peer = create_connection(settings[id], timeout=REPLICA_TIMEOUT)
+        except OSError as e:
+            return error(f"Could not connect to {id}: {e}")
+        peer.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        connection = Connection(peer)
+        if not connection.negotiate():
+            connection.close()
+            return error(f"Peer {id} does not speak protocol {PROTOCOL_VERSION}")
+        return connection
+
+    # Declare the upload to the first peer of the chain that takes it, skipping those that are down
+    def open(self, upload: PartialUpload):
+        settings = readSettings() or dict()
+        for i, id in enumerate(self.chain):
+            connection = self.connect(id, settings)
+            if connection is None:
+                self.failed.append(id)
+                continue
+            intent = Command(CommandType.UPLOAD, filename=self.filename, bytes=upload.size, chunkSize=upload.chunkSize, digest=upload.digest, hashes=upload.hashes, replicate=self.chain[i + 1:])
+            response = connection.receiveResponse() if connection.send(intent) else None
+            if response is not None and response.code.ok(): # Already had the content
+                connection.close()
+                self.chain, self.final = self.chain[i:], response
+                return
+            if response is not None and response.code.ready() and response.value("chunksize") == upload.chunkSize:
+                log(f"Replicating {self.filename} to {id}")
+                self.chain, self.connection = self.chain[i:], connection
+                self.held = bytes.fromhex(response.option("received") or "")
+                Thread(target=self.collect, args=(connection,), daemon=True).start()
+                return
+            error(f"Peer {id} does not take {self.filename}: {response.toString() if response is not None else "no response"}")
+            connection.close()
+            self.failed.append(id)
+        self.chain = []
+
+    def forward(self, chunk: int, content: str | bytes):
+        if chunk // 8 < len(self.held) and self.held[chunk // 8] >> (chunk % 8) & 1:
+            return
+        with self.lock:
+            if self.connection is None:
+                return
+            with self.condition:
+                self.sent += 1
+            if not self.connection.send(Command(CommandType.UPLOAD, filename=self.filename, chunk=chunk, content=toBytes(content))):
+                self.connection.close()
+                self.connection = None
+
+    # Pass on chunks that arrived before the replica was opened, e.g. kept from an earlier attempt
+    def backfill(self, path: str, chunks: list[int]):
+        for chunk in chunks:
+            if self.connection is None:
+                return
+            self.forward(chunk, chunkReader.readChunk(path, chunk, self.chunkSize))
+
+    def collect(self, connection: Connection):
+        while True:
+            response = connection.receiveResponse()
+            with self.condition:
+                if response is None:
+                    self.broken = True
+                elif response.option("chunk") is None: # Only the response completing the file has no chunk no.
+                    self.final = response
+                else:
+                    self.answered += 1
+                self.condition.notify_all()
+                if response is None or self.final is not None:
+                    return
+
+    # Wait for the chain to take the last chunk, returning (peers replicated to, peers not)
+    def finish(self) -> tuple[list[str], list[str]]:
+        with self.condition:
+            while self.connection is not None and self.final is None and not self.broken and self.answered < self.sent:
+                if not self.condition.wait(REPLICA_TIMEOUT):
+                    break
+            final = self.final
+        self.close()
+        if final is None or not final.code.ok():
+            return [], self.failed + self.chain
+        replicated = final.option("replicated")
+        unreplicated = final.option("unreplicated")
+        return [self.chain[0]] + (replicated.split(",") if replicated is not None else []), self.failed + (unreplicated.split(",") if unreplicated is not None else [])
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+
+class Handler:
+    uploads: dict[str, PartialUpload]  # Map filename to command
+    workerUploads: set[str] # Set of uploads started on this connection
+    serverId: str
+    text: tuple[str, int, list[str]] | None # (filename, mtime, chunks) of the file a legacy peer is downloading on this connection
+
+    def __init__(self, uploads: dict[str, PartialUpload], serverId: str):
+        self.uploads = uploads
+        self.serverId = serverId
+        self.workerUploads = set()
+        self.text = None
 
     def handle(self, command: Command) -> Response:
         match command.type:
             case CommandType.FILELIST:
-                filelist = [filename for filename in listdir(
-                    path("served_files/")) if isfile(path(f"served_files/{filename}"))]
-                return Response(code=ResponseCode(200), content="Files served: " + " ".join(filelist))
+                if (command.offset or 0) < 0 or (command.limit or 0) < 0:
+                    return Response(code=ResponseCode(250), content=f"Invalid page offset {command.offset} limit {command.limit}")
+                filelist, total = fileIndex.listing(command.pattern, command.offset or 0, command.limit)
+                page = f" ({(command.offset or 0) + 1}-{(command.offset or 0) + len(filelist)} of {total})" if len(filelist) < total else ""
+                return Response(code=ResponseCode(200), content=f"Files served{page}: " + " ".join(f"{filename} ({size}B)" for filename, size in filelist))
             case CommandType.UPLOAD:
                 if command.bytes is not None:  # Declare upload intention
-                    with uploadsLock:
+                    if fileIndex.get(command.filename) is not None:
+                        return Response(code=ResponseCode(250), content=f"Already serving file {command.filename}")
+                    if isPartial(command.filename):
+                        return Response(code=ResponseCode(250), content=f"Invalid file name {command.filename}")
+                    chunkSize = min(command.chunkSize, MAX_CHUNK_SIZE) if command.chunkSize is not None else CHUNK_SIZE
+                    if chunkSize <= 0:
+                        return Response(code=ResponseCode(250), content=f"Invalid chunk size {chunkSize}")
+                    if command.bytes < 0:
+                        return Response(code=ResponseCode(250), content=f"Invalid size {command.bytes}")
+                    if command.bytes > freeSpace(command.filename): # Checked before anything is allocated for the declared size
+                        return Response(code=ResponseCode(250), content=f"No space for file {command.filename} of {command.bytes}B")
+                    # Save upload intention command. Only the check-and-register happens under the global lock, the file is created outside it
+                    upload = PartialUpload(command.filename, command.bytes, chunkSize, command.digest, command.hashes, legacy=command.chunkSize is None)
+                    with stats.locked(uploadsLock):
                         if command.filename in self.uploads.keys():
                             return Response(code=ResponseCode(250), content=f"Currently receiving file {command.filename}")
-                    if exists(served(command.filename)):
-                        return Response(code=ResponseCode(250), content=f"Already serving file {command.filename}")
-                    # Save upload intention command
-                    with uploadsLock:
-                        self.uploads[command.filename] = PartialUpload(command.filename, command.bytes)
+                        self.uploads[command.filename] = upload
+                    if not upload.claim(): # Another worker process is receiving it
+                        with stats.locked(uploadsLock):
+                            self.uploads.pop(command.filename)
+                        return Response(code=ResponseCode(250), content=f"Currently receiving file {command.filename}")
+                    chain = [id for id in command.replicate or [] if id != self.serverId]
+                    if len(chain) > 0:
+                        upload.replica = Replica(command.filename, chain, chunkSize)
+                        upload.replica.open(upload)
+                    if command.digest is not None: # Already serving the same content under another name, no need to send it again
+                        source = fileIndex.find(command.digest, command.bytes)
+                        if source is not None and upload.adopt(source):
+                            with stats.locked(uploadsLock):
+                                self.uploads.pop(command.filename)
+                            upload.release()
+                            log(f"Completely uploaded {command.filename}, copied from {source}")
+                            return Response(code=ResponseCode(200), content=f"File {command.filename} received{self.replicate(upload, range(upload.noOfChunks()))}")
+                    try:
+                        upload.open()
+                    except OSError as e:
+                        error(f"{e}")
+                        upload.discard()
+                        with stats.locked(uploadsLock):
+                            self.uploads.pop(command.filename)
+                        upload.release()
+                        if upload.replica is not None:
+                            upload.replica.close()
+                        return Response(code=ResponseCode(250), content=f"Cannot receive file {command.filename}")
                     self.workerUploads.add(command.filename)
-                    log(f"Upload intention received: {command.filename}, {command.bytes}B, {self.uploads[command.filename].noOfChunks()} chunks")
-                    response = Response(code=ResponseCode(330), content=f"Ready to receive file {command.filename}")
-                    return response
+                    log(f"Upload intention received: {command.filename}, {command.bytes}B, {upload.noOfChunks()} chunks")
+                    if upload.replica is not None and upload.noReceived > 0: # The client will not send these again
+                        upload.replica.backfill(partial(command.filename), [chunk for chunk in range(upload.noOfChunks()) if upload.received[chunk // 8] >> (chunk % 8) & 1])
+                    if upload.finish(): # Resumed with every chunk already here
+                        return self.complete(upload)
+                    if command.chunkSize is None: # Peer does not negotiate chunk sizes
+                        return Response(code=ResponseCode(330), content=f"Ready to receive file {command.filename}")
+                    # Chunks kept from an earlier attempt need not be sent again
+                    return Response(code=ResponseCode(330), content=f"Ready to receive file {command.filename} chunksize {chunkSize}{f" received {upload.received.hex()}" if upload.noReceived > 0 else ""}{f" compress {command.codec.toString()}" if command.codec is not None else ""}")
                 elif command.chunk is not None and command.content is not None:  # Actually upload chunks
-                    with uploadsLock:
-                        self.uploads[command.filename].save(command.chunk, command.content)
-                        log(f"Upload {"complete" if self.uploads[command.filename].isComplete() else "not complete"}")
-                        if self.uploads[command.filename].isComplete():
-                            log("Writing to disk...")
-                            self.uploads[command.filename].writeToDisk()
-                            log(f"Completely uploaded {command.filename}")
-                            self.uploads.pop(command.filename)
-                            self.workerUploads.remove(command.filename)
-                            return Response(code=ResponseCode(200), content=f"File {command.filename} received")
+                    with stats.locked(uploadsLock):
+                        upload = self.uploads.get(command.filename)
+                    if upload is None:
+                        return Response(code=ResponseCode(250), content=f"Not receiving file {command.filename}")
+                    if len(upload.corrupt(command.chunk * upload.chunkSize, command.content)) > 0:
+                        return Response(code=ResponseCode(250), content=f"File {command.filename} chunk {command.chunk} is corrupt")
+                    if not upload.save(command.chunk, command.content):
+                        return Response(code=ResponseCode(250), content=f"Invalid chunk {command.chunk} of file {command.filename}")
+                    if upload.replica is not None:
+                        upload.replica.forward(command.chunk, command.content)
+                    if upload.finish():
+                        return self.complete(upload)
                     return Response(code=ResponseCode(200), content=f"File {command.filename} chunk {command.chunk} received")
             case CommandType.DOWNLOAD:
-                if command.chunk is None:  # Declare download intention
+                if command.offset is not None: # Byte range, may span many chunks or be a partial/ tail read
+                    file = fileIndex.get(command.filename)
+                    held = HeldFile.load(command.filename) if file is None else None
+                    if file is None and held is None:
+                        return Response(code=ResponseCode(250), content=f"Not serving file {command.filename}")
+                    size = file.size if file is not None else held.size
+                    if command.offset < 0 or command.offset > size or command.length < 0 or command.length > MAX_RANGE_SIZE:
+                        return Response(code=ResponseCode(250), content=f"Invalid range {command.offset} {command.length}")
+                    length = min(command.length, size - command.offset)
+                    if held is not None: # Still downloading, only chunks already here can be served
+                        if not held.holds(command.offset, length):
+                            return Response(code=ResponseCode(250), content=f"Not holding file {command.filename} range {command.offset} {length}")
+                        return Response(code=ResponseCode(200), content=f"File {command.filename} range {command.offset} {length}", filename=command.filename, offset=command.offset, fileRange=(partial(command.filename), command.offset, length), codec=command.codec)
+                    return Response(code=ResponseCode(200), content=f"File {command.filename} range {command.offset} {length}", filename=command.filename, offset=command.offset, data=blockCache.read(command.filename, file.mtime, command.offset, length), fileRange=(served(command.filename), command.offset, length), codec=command.codec)
+                elif command.chunk is None:  # Declare download intention
                     log("Declare download intention")
-                    with uploadsLock:
-                        if not exists(served(command.filename)) or command.filename in self.uploads.keys():
+                    with stats.locked(uploadsLock):
+                        receiving = command.filename in self.uploads.keys()
+                    file = fileIndex.get(command.filename)
+                    if file is None and command.chunkSize is not None: # Swarming peers may fetch the chunks held so far
+                        held = HeldFile.load(command.filename)
+                        if held is not None and held.size > 0:
+                            log(f"Received download intent: {command.filename}, {held.size}B, partially held")
+                            return Response(code=ResponseCode(330), content=f"Ready to send file {command.filename} bytes {held.size} chunksize {held.chunkSize} maxrange {MAX_RANGE_SIZE}{f" compress {command.codec.toString()}" if command.codec is not None else ""} have {held.received.hex()} digest {held.digest} manifest {",".join(held.hashes)}")
+                    if receiving or file is None:
+                        return Response(code=ResponseCode(250), content=f"Not serving file {command.filename}")
+                    size = file.size
+                    log(f"Received download intent: {command.filename}, {size}B")
+                    if command.chunkSize is None: # Peer does not negotiate chunk sizes, and counts characters
+                        chunks = self.textChunks(command.filename, file)
+                        if chunks is None:
                             return Response(code=ResponseCode(250), content=f"Not serving file {command.filename}")
-                        size = getsize(served(command.filename))
-                        log(f"Received download intent: {command.filename}, {size}B")
-                    return Response(code=ResponseCode(330), content=f"Ready to send file {command.filename} bytes {size}")
+                        return Response(code=ResponseCode(330), content=f"Ready to send file {command.filename} bytes {sum(len(chunk) for chunk in chunks)}")
+                    return Response(code=ResponseCode(330), content=f"Ready to send file {command.filename} bytes {size} chunksize {min(command.chunkSize, MAX_CHUNK_SIZE)} maxrange {MAX_RANGE_SIZE}{f" compress {command.codec.toString()}" if command.codec is not None else ""}{self.manifest(command.filename)}")
                 else:  # Actually download chunks
-                    content = sever(served(command.filename))[command.chunk]
-                    log(f"Return content:\n{content}")
-                    return Response(code=ResponseCode(200), content=f"File {command.filename} chunk {command.chunk} {content}")
+                    chunkSize = command.chunkSize if command.chunkSize is not None else CHUNK_SIZE
+                    if chunkSize <= 0 or chunkSize > MAX_CHUNK_SIZE:
+                        return Response(code=ResponseCode(250), content=f"Invalid chunk size {chunkSize}")
+                    file = fileIndex.get(command.filename)
+                    if file is None:
+                        return Response(code=ResponseCode(250), content=f"Not serving file {command.filename}")
+                    if command.chunkSize is None: # Chunks of characters, see textChunks()
+                        chunks = self.textChunks(command.filename, file)
+                        if chunks is None:
+                            return Response(code=ResponseCode(250), content=f"Not serving file {command.filename}")
+                        if command.chunk < 0 or command.chunk > len(chunks):
+                            return Response(code=ResponseCode(250), content=f"Invalid chunk {command.chunk}")
+                        return Response(code=ResponseCode(200), content=f"File {command.filename} chunk {command.chunk}", filename=command.filename, chunk=command.chunk, data=chunks[command.chunk] if command.chunk < len(chunks) else "")
+                    size = file.size
+                    offset = command.chunk * chunkSize
+                    if command.chunk < 0 or offset > size:
+                        return Response(code=ResponseCode(250), content=f"Invalid chunk {command.chunk}")
+                    length = min(chunkSize, size - offset)
+                    # Unless the file is hot, the content is read (or sent straight from the file) by the connection
+                    return Response(code=ResponseCode(200), content=f"File {command.filename} chunk {command.chunk}", filename=command.filename, chunk=command.chunk, data=blockCache.read(command.filename, file.mtime, offset, length), fileRange=(served(command.filename), offset, length), codec=command.codec)
+            case CommandType.STATS:
+                return Response(code=ResponseCode(200), content=f"Stats {json.dumps(stats.snapshot(self.uploads))}")
+            case CommandType.PROTOCOL:
+                if command.content == str(PROTOCOL_VERSION):
+                    return Response(code=ResponseCode(200), content=f"Protocol {PROTOCOL_VERSION}")
+                return Response(code=ResponseCode(250), content=f"Unsupported protocol {command.content}")
             case CommandType.DELETE:
-                if exists(served(command.filename)) and isfile(served(command.filename)):
-                    Path(served(command.filename)).unlink()
+                if fileIndex.get(command.filename) is not None:
+                    chunkReader.discard(served(command.filename))
+                    blockCache.discard(command.filename)
+                    fileIndex.discard(command.filename)
+                    Path(served(command.filename)).unlink(missing_ok=True) # Unless removed behind the server's back since the last scan
                     log(f"Deleted file {command.filename}")
                     return Response(code=ResponseCode(200), content=f"Deleted file {command.filename}")
                 else:
@@ -395,23 +1941,109 @@ class ServerWorker(Thread):
             case _:
                 raise "Invalid command type"
 
+    # Move a finished upload into place, the caller must have won upload.finish()
+    def complete(self, upload: PartialUpload) -> Response:
+        if upload.verify():
+            log("Writing to disk...")
+            upload.writeToDisk()
+            log(f"Completely uploaded {upload.filename}")
+            response = Response(code=ResponseCode(200), content=f"File {upload.filename} received{self.replicate(upload)}")
+        else:
+            if upload.replica is not None:
+                upload.replica.close()
+            upload.discard()
+            response = Response(code=ResponseCode(250), content=f"File {upload.filename} is corrupt")
+        # Only now, so that nobody starts receiving the same file into the partial file while it is moved into place
+        with stats.locked(uploadsLock):
+            self.uploads.pop(upload.filename)
+        upload.release()
+        self.workerUploads.discard(upload.filename)
+        return response
+
+    # Wait for the replication chain, if any, to take the upload after passing on the given chunks of the now
+    # complete file. " replicated P,Q unreplicated R" for the final upload response
+    def replicate(self, upload: PartialUpload, chunks: range = range(0)) -> str:
+        if upload.replica is None:
+            return ""
+        upload.replica.backfill(served(upload.filename), list(chunks))
+        replicated, unreplicated = upload.replica.finish()
+        log(f"Replicated {upload.filename} to {replicated}{f", not to {unreplicated}" if len(unreplicated) > 0 else ""}")
+        return f"{f" replicated {",".join(replicated)}" if len(replicated) > 0 else ""}{f" unreplicated {",".join(unreplicated)}" if len(unreplicated) > 0 else ""}"
+
+    # A served file cut into chunks for a legacy peer, read once per connection rather than for every chunk
+    def textChunks(self, filename: str, file: ServedFile) -> list[str] | None:
+        if self.text is None or self.text[:2] != (filename, file.mtime):
+            try:
+                self.text = (filename, file.mtime, textChunks(served(filename)))
+            except OSError as e:
+                return error(f"{e}")
+        return self.text[2]
+
+    # " digest D manifest h1,h2,..." for a download intent response, if the file is already hashed
+    def manifest(self, filename: str) -> str:
+        indexed = fileIndex.indexed(filename)
+        if indexed is None: # Not hashed yet, the client checks the whole file at the end instead
+            return ""
+        digest, hashes = indexed
+        return f" digest {digest}{f" manifest {",".join(hashes)}" if len(hashes) > 0 else ""}"
+
+    # An upload is in progress on this connection, so the next chunk may take a while
+    def isReceiving(self) -> bool:
+        return len(self.workerUploads) > 0
+
+    def close(self):
+        with stats.locked(uploadsLock):
+            abandoned = [self.uploads.pop(file) for file in self.workerUploads if file in self.uploads]
+        for upload in abandoned: # Kept on disk so that a retried upload only sends what is missing
+            if upload.replica is not None:
+                upload.replica.close()
+            upload.suspend()
+            upload.release()
+
+
+class ServerWorker(Thread):
+    client: tuple[socket, object]
+    connectionSocket: socket
+    connection: Connection
+    handler: Handler
+    idleTimeout: float
+
+    def __init__(self, client: tuple[socket, object], uploads: dict[str, PartialUpload], serverId: str, idleTimeout: float = IDLE_TIMEOUT, group=None, target=None, name=None, args=..., kwargs=None, *, daemon=None):
+        super().__init__(group, target, name, args, kwargs, daemon=daemon)
+        log("New ServerWorker")
+        self.client = client
+        self.connectionSocket, addr = self.client
+        self.idleTimeout = idleTimeout
+        self.connectionSocket.settimeout(idleTimeout)
+        self.connectionSocket.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1) # Else a frame header sent apart from its sendfile payload waits for a delayed ACK
+        self.connection = Connection(self.connectionSocket)
+        self.handler = Handler(uploads, serverId)
+
     def run(self):
+        stats.connected()
         try:
             try:
                 while True:
-                    commandStr = self.receive()
-                    if commandStr is None:
+                    self.connectionSocket.settimeout(max(self.idleTimeout, UPLOAD_IDLE_TIMEOUT) if self.handler.isReceiving() else self.idleTimeout)
+                    received = self.connection.receive()
+                    if received is None:
                         return
-                    log(f"Received commandStr: {commandStr}")
-                    command: Command = Command.fromSafeString(commandStr)
-                    log(f"Converted to command {command.toString()}")
+                    start = perf_counter()
+                    log(f"Received: {received if isinstance(received, str) else received.opcode}")
+                    command: Command = Command.fromReceived(received)
                     if command is None:
-                        error(f"Invalid command: {commandStr}")
-                        self.send(Response(code=ResponseCode(250), content=f"Invalid command: {commandStr}").toString())
+                        error(f"Invalid command: {received}")
+                        self.connection.send(Response(code=ResponseCode(250), content=f"Invalid command"))
+                        return
+                    log(f"Converted to command {command.toDisplayString()}")
+                    response = self.handler.handle(command)
+                    log(response.toDisplayString())
+                    sent = self.connection.send(response)
+                    stats.command(command.type, perf_counter() - start, response.code.err() or not sent)
+                    if not sent:
                         return
-                    response = self.handle(command)
-                    log(response.toString())
-                    self.send(response.toSafeString())
+                    if command.type == CommandType.PROTOCOL and response.code.ok():
+                        self.connection.binary = True
             except ConnectionResetError:
                 log(f"Connection reset by client")
                 raise
@@ -420,19 +2052,199 @@ class ServerWorker(Thread):
         finally:
             log("Close client connection")
             self.connectionSocket.close()
-            with uploadsLock:
-                for file in self.workerUploads:
-                    if file in self.uploads:
-                        self.uploads.pop(file)
+            self.handler.close()
+            stats.disconnected()
             log("Exit ServerWorker")
             return
 
 
+class AsyncConnection:
+    reader: asyncio.StreamReader
+    writer: asyncio.StreamWriter
+    buffer: bytearray # Received but not yet consumed
+    binary: bool # Protocol v2 framing negotiated
+    timeout: float | None # s without any bytes arriving before a receive gives up, like a socket timeout
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.buffer = bytearray()
+        self.binary = False
+        self.timeout = None
+
+    # Wait at most timeout for more bytes, so that a slow sender is only dropped once it stops sending altogether
+    async def read(self, length: int) -> bytes | None:
+        try:
+            received = await asyncio.wait_for(self.reader.read(length), self.timeout)
+        except asyncio.TimeoutError:
+            stats.timeout()
+            return error("Timeout while receiving")
+        except OSError as e:
+            return error(f"Could not receive: {e}")
+        if len(received) == 0:
+            return error("Connection closed")
+        stats.transferred(bytesIn=len(received))
+        return received
+
+    async def fill(self) -> bool:
+        received = await self.read(65536)
+        if received is None:
+            return False
+        self.buffer += received
+        return True
+
+    async def receiveExactly(self, length: int) -> bytes | None:
+        while len(self.buffer) < length:
+            if not await self.fill():
+                return None
+        received = bytes(self.buffer[:length])
+        del self.buffer[:length]
+        return received
+
+    async def receiveLine(self) -> str | None:
+        end = self.buffer.find(b"\n")
+        while end < 0:
+            if len(self.buffer) > MAX_LINE_SIZE:
+                return error("Line too long")
+            searched = len(self.buffer)
+            if not await self.fill():
+                return None
+            end = self.buffer.find(b"\n", searched)
+        line = self.buffer[:end + 1]
+        del self.buffer[:end + 1]
+        try:
+            return line.decode()
+        except UnicodeDecodeError:
+            return error("Invalid line")
+
+    async def receiveFrame(self) -> Frame | None:
+        header = await self.receiveExactly(FRAME.size)
+        if header is None:
+            return None
+        opcode, flags, filenameLength, offset, payloadLength = FRAME.unpack(header)
+        if payloadLength > MAX_FRAME_SIZE:
+            return error(f"Frame payload of {payloadLength} bytes too long")
+        filename = await self.receiveExactly(filenameLength)
+        payload = await self.receiveInto(payloadLength)
+        if filename is None or payload is None:
+            return None
+        try:
+            return Frame(opcode, flags, filename.decode(), offset, payload)
+        except UnicodeDecodeError:
+            return error("Invalid file name in frame")
+
+    # Receive a payload into a preallocated buffer, see Connection.receiveInto()
+    async def receiveInto(self, length: int) -> bytearray | None:
+        payload = bytearray(length)
+        view = memoryview(payload)
+        received = min(len(self.buffer), length)
+        view[:received] = self.buffer[:received]
+        del self.buffer[:received]
+        while received < length:
+            content = await self.read(length - received)
+            if content is None:
+                return None
+            view[received:received + len(content)] = content
+            received += len(content)
+        return payload
+
+    async def receive(self) -> str | Frame | None:
+        return await self.receiveFrame() if self.binary else await self.receiveLine()
+
+    async def send(self, message: "Command | Response") -> bool:
+        try:
+            if isinstance(message, Response) and message.fileRange is not None and message.data is None and self.binary:
+                return await self.sendFileRange(message)
+            wire = message.toWire(self.binary)
+            self.writer.write(wire)
+            await self.writer.drain()
+            stats.transferred(bytesOut=len(wire))
+        except OSError as e:
+            return error(f"Could not send: {e}")
+        return True
+
+    async def sendFileRange(self, response: Response) -> bool:
+        path, offset, length = response.fileRange
+        header = response.toFrame().header(length)
+        if length == 0:
+            self.writer.write(header)
+            await self.writer.drain()
+            return True
+        with open(path, 'rb') as file: # Opened before the header goes out, a partial file may be renamed meanwhile
+            self.writer.write(header)
+            await self.writer.drain()
+            sent = await asyncio.get_running_loop().sendfile(self.writer.transport, file, offset, length)
+        stats.transferred(bytesOut=len(header) + sent)
+        if sent != length: # File shrank underneath us, the frame is broken
+            return error(f"Sent {sent} of {length} bytes of {path}")
+        return True
+
+    async def close(self):
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except OSError:
+            pass
+
+
+class AsyncServerWorker:
+    connection: AsyncConnection
+    handler: Handler
+    executor: ThreadPoolExecutor # Runs handle() and with it all file I/O
+    idleTimeout: float
+
+    def __init__(self, connection: AsyncConnection, handler: Handler, executor: ThreadPoolExecutor, idleTimeout: float):
+        self.connection = connection
+        self.handler = handler
+        self.executor = executor
+        self.idleTimeout = idleTimeout
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        stats.connected()
+        try:
+            while True:
+                self.connection.timeout = max(self.idleTimeout, UPLOAD_IDLE_TIMEOUT) if self.handler.isReceiving() else self.idleTimeout
+                received = await self.connection.receive()
+                if received is None:
+                    return
+                start = perf_counter()
+                command: Command = Command.fromReceived(received)
+                if command is None:
+                    error(f"Invalid command: {received}")
+                    await self.connection.send(Response(code=ResponseCode(250), content=f"Invalid command"))
+                    return
+                log(f"Converted to command {command.toDisplayString()}")
+                response = await loop.run_in_executor(self.executor, self.handler.handle, command)
+                log(response.toDisplayString())
+                if not self.connection.binary: # Text protocol needs the chunk content in memory, read it off the loop
+                    await loop.run_in_executor(self.executor, response.load)
+                else: # So does compression
+                    await loop.run_in_executor(self.executor, response.compress)
+                sent = await self.connection.send(response)
+                stats.command(command.type, perf_counter() - start, response.code.err() or not sent)
+                if not sent:
+                    return
+                if command.type == CommandType.PROTOCOL and response.code.ok():
+                    self.connection.binary = True
+        finally:
+            log("Close client connection")
+            await self.connection.close()
+            await loop.run_in_executor(self.executor, self.handler.close)
+            stats.disconnected()
+
+
 class Server:
     id: str
     addr: str
     port: int
     uploads: dict[str, PartialUpload]
+    engine: str # "threads" or "asyncio"
+    backlog: int
+    idleTimeout: float # s
+    ioThreads: int # Size of the asyncio engine's file I/O executor
+    workers: int # No. of processes accepting connections on the same port
+    children: list[int] # pids of the worker processes, in the parent
 
     def __init__(self):
         global debug
@@ -441,7 +2253,7 @@ class Server:
         except IndexError:
             error(f"Did not receive peer id")
             raise
-        if len(sys.argv) == 3 and sys.argv[2] == "debug":
+        if "debug" in sys.argv[2:]:
             debug = True
         try:
             self.addr, self.port = readSettings()[self.id]
@@ -449,18 +2261,93 @@ class Server:
             error(f"Could not find setting for peer {self.id}")
             raise
         self.uploads = dict()
+        self.engine = argument("engine") or "threads"
+        self.backlog = int(argument("backlog") or 5)
+        self.idleTimeout = float(argument("idle") or IDLE_TIMEOUT)
+        self.ioThreads = int(argument("iothreads") or 8)
+        self.workers = int(argument("workers") or 1)
+        blockCache.budget = int(float(argument("cache") or CACHE_BUDGET / 1024 / 1024) * 1024 * 1024) # MiB
+        self.children = []
+        if self.workers > 1 and not (hasattr(os, "fork") and "SO_REUSEPORT" in globals()):
+            error(f"Cannot run {self.workers} worker processes on this platform, running one")
+            self.workers = 1
 
     def run(self):
+        if self.workers > 1:
+            return self.fork()
+        self.listen()
+
+    # Fork the worker processes, each binding its own socket to the port with SO_REUSEPORT so that the kernel
+    # spreads connections over them. Uploads stay on the connection they started on, and PartialUpload.claim()
+    # keeps two processes from receiving the same file. The parent watches served_files/, hashing each file once for all
+    def fork(self):
+        fileIndex.shared = True
+        for process in range(self.workers):
+            pid = os.fork() # Before any thread is started, so that every child starts clean
+            if pid == 0:
+                stats.process = process
+                try:
+                    self.listen()
+                except KeyboardInterrupt:
+                    pass
+                finally:
+                    os._exit(1) # Only returns if it could not bind
+            self.children.append(pid)
+        Thread(target=fileIndex.watch, daemon=True).start() # Hashing for all workers, see FileIndex.saveDigest()
+        log(f"Server {self.id} running {self.workers} worker processes")
+        signal.signal(signal.SIGTERM, lambda signum, frame: exit())
+        try:
+            while len(self.children) > 0:
+                pid, status = os.wait()
+                if pid in self.children:
+                    self.children.remove(pid)
+                    error(f"Worker process {pid} exited with status {os.waitstatus_to_exitcode(status)}")
+        except KeyboardInterrupt: # Delivered to the workers too
+            pass
+        finally:
+            self.stop()
+
+    def stop(self):
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def listen(self):
+        if self.workers == 1: # Else the parent watches
+            Thread(target=fileIndex.watch, daemon=True).start()
+        if argument("stats") is not None:
+            Thread(target=stats.dump, args=(f"{argument("stats")}{f".{stats.process}" if stats.process is not None else ""}", self.uploads), daemon=True).start()
+        if self.engine == "asyncio":
+            return asyncio.run(self.serve())
         try:
             serverSocket = socket(AF_INET, SOCK_STREAM)
+            if self.workers > 1:
+                serverSocket.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
             serverSocket.bind((self.addr, self.port))
-            serverSocket.listen(5)
+            serverSocket.listen(self.backlog)
         except OSError:
             return error(f"Could not bind to {self.addr}:{self.port}")
-        log(f"Server {self.id} listening on port {self.addr}:{self.port}")
+        log(f"Server {self.id} listening on port {self.addr}:{self.port}{f" (process {stats.process})" if stats.process is not None else ""}")
         while True:
             client = serverSocket.accept()
-            ServerWorker(client, self.uploads, self.id).start()
+            ServerWorker(client, self.uploads, self.id, self.idleTimeout).start()
+
+    async def serve(self):
+        executor = ThreadPoolExecutor(max_workers=self.ioThreads)
+
+        async def serveClient(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+            log("New AsyncServerWorker")
+            await AsyncServerWorker(AsyncConnection(reader, writer), Handler(self.uploads, self.id), executor, self.idleTimeout).run()
+
+        try:
+            server = await asyncio.start_server(serveClient, self.addr, self.port, backlog=self.backlog, limit=MAX_LINE_SIZE, reuse_port=self.workers > 1)
+        except OSError:
+            return error(f"Could not bind to {self.addr}:{self.port}")
+        log(f"Server {self.id} listening on port {self.addr}:{self.port} (asyncio{f", process {stats.process}" if stats.process is not None else ""})")
+        async with server:
+            await server.serve_forever()
 
 
 if __name__ == "__main__":